@@ -8,10 +8,18 @@ from collections import OrderedDict, namedtuple
 from itertools import combinations
 
 from pade.stat import (
-    OneSampleDifferenceTStat, FStat, MeansRatio, residuals, bootstrap)
+    OneSampleDifferenceTStat, FStat, MeansRatio, residuals, bootstrap,
+    cumulative_hist, cumulative_hist_shape, confidence_scores,
+    assign_scores_to_features, chunked_percentile)
 
 from pade.model import TableWithHeader, Summary
-from pade.layout import random_orderings, layout_is_paired
+from pade.layout import layout_is_paired, SampleIndexSpec
+
+DEFAULT_STOP_CHECK_INTERVAL = 100
+"""Number of samples to run between checks for stopping early."""
+
+DEFAULT_STOP_CHECKS = 2
+"""Number of checks in a row the counts must settle for before we stop."""
 
 def predicted_values(job):
     """Return the values predicted by the reduced model.
@@ -44,17 +52,99 @@ def summary_by_conf_level(job):
 
     """
     
-    bins = np.arange(job.settings.summary_min_conf, 1.0, job.settings.summary_step_size)
-    best_param_idxs = np.zeros(len(bins))
-    counts          = np.zeros(len(bins))
+    bins = summary_conf_levels(job.settings)
+    (best_param_idxs, counts) = conf_level_counts(
+        job.results.feature_to_score, bins)
+    return Summary(bins, best_param_idxs, counts)
+
+def summary_conf_levels(settings):
+    """Returns the confidence levels the summary reports on."""
+    return np.arange(settings.summary_min_conf, 1.0, settings.summary_step_size)
+
+def conf_level_counts(feature_to_score, conf_levels):
+    """Count the features with a score above each confidence level.
+
+    For each level we pick the tuning param that gives the most
+    features above it.
+
+    :param feature_to_score:
+      A (tuning params x features) array of confidence scores.
+
+    :param conf_levels:
+      The confidence levels to count features for.
+
+    :return:
+      A pair of arrays giving the index of the best tuning param and
+      the number of features above each level.
+
+    >>> scores = np.array([[0.2, 0.6, 0.9], [0.5, 0.7, 0.45]])
+    >>> conf_level_counts(scores, [0.4, 0.8])
+    (array([ 1.,  0.]), array([ 3.,  1.]))
 
-    for i, conf in enumerate(bins):
-        idxs = job.results.feature_to_score > conf
+    """
+    best_param_idxs = np.zeros(len(conf_levels))
+    counts          = np.zeros(len(conf_levels))
+
+    for i, conf in enumerate(conf_levels):
+        idxs = feature_to_score > conf
         best = np.argmax(np.sum(idxs, axis=1))
         best_param_idxs[i] = best
         counts[i]  = np.sum(idxs[best])
 
-    return Summary(bins, best_param_idxs, counts)
+    return (best_param_idxs, counts)
+
+def counts_settled(old, new, tolerance):
+    """Tells whether each count moved by no more than tolerance.
+
+    The tolerance is a fraction of the old count, where counts below
+    one are treated as one.
+
+    >>> counts_settled([200, 10, 0], [202, 10, 0], 0.01)
+    True
+    >>> counts_settled([200, 10, 0], [202, 11, 0], 0.01)
+    False
+
+    """
+    old = np.asarray(old, float)
+    new = np.asarray(new, float)
+    return bool(np.all(np.abs(new - old) <= tolerance * np.maximum(old, 1)))
+
+def compute_raw_stats(job, fold_change_alpha=None):
+    """Compute the per-feature statistics for the job's input.
+
+    :param job:
+      The pade.model.Job
+
+    :param fold_change_alpha:
+      Passed on to compute_fold_change. Supply this when the input
+      is only a chunk of the features of the job.
+
+    :return:
+      A 4-tuple of the raw statistics, and TableWithHeaders giving
+      the coefficients, fold change, and group means.
+
+    """
+    raw_stats    = job.get_stat_fn()(job.input.table)
+    coeff_values = compute_coeffs(job)
+    fold_change  = compute_fold_change(job, fold_change_alpha)
+    group_means  = compute_means(job)
+    return (raw_stats, coeff_values, fold_change, group_means)
+
+def fold_change_alpha(table, chunk_size=None):
+    """Returns the value added to means before computing fold change.
+
+    This is the 1st percentile of all the values in the table, and
+    keeps us from dividing by zero.
+
+    :param chunk_size:
+      If given, only read this many rows of the table at a time, so
+      that table can be an HDF5 dataset too big to load. The result is
+      the same.
+
+    """
+    if chunk_size is not None:
+        return chunked_percentile(table, 1.0, chunk_size)
+    return scipy.stats.scoreatpercentile(np.ravel(table), 1.0)
 
 def compute_coeffs(job):
     """Calculate the coefficients for the full model.
@@ -74,12 +164,16 @@ def compute_coeffs(job):
 
 
 
-def compute_fold_change(job):
+def compute_fold_change(job, alpha=None):
     """Compute fold change.
 
     :param job:
       The pade.model.Job
 
+    :param alpha:
+      Value to add to the means before taking their ratio. Defaults
+      to fold_change_alpha of the job's input table.
+
     :return:
       A TableWithHeader giving the fold change for each non-baseline
       group for each feature.
@@ -100,7 +194,8 @@ def compute_fold_change(job):
     data = job.input.table
     get_means = lambda a: np.mean(data[:, job.schema.indexes_with_assignments(a)], axis=-1)
 
-    alpha = scipy.stats.scoreatpercentile(job.input.table.flatten(), 1.0)
+    if alpha is None:
+        alpha = fold_change_alpha(job.input.table)
 
     for na in nuisance_assignments:
         test_assignments = job.schema.possible_assignments(test_factors)
@@ -159,12 +254,23 @@ def get_group_means(schema, data, factors):
 
     return result
 
-def new_sample_indexes(job):
+def new_sample_index_spec(job, seed=None):
+    """Describe the sample indexes for the job without constructing them.
 
-    """Create array of sample indexes."""
+    :param seed:
+      Seed for the random samplings. By default one is drawn from
+      numpy's global random state.
 
+    :return:
+      A pade.layout.SampleIndexSpec, which gives the indexes for any
+      range of the samplings when sliced.
+
+    """
     R  = job.settings.num_samples
 
+    if seed is None:
+        seed = np.random.randint(0, 2 ** 31 - 1)
+
     if job.settings.sample_with_replacement:
         if job.settings.sample_from_residuals:
             logging.debug("Bootstrapping using samples constructed from " +
@@ -174,61 +280,188 @@ def new_sample_indexes(job):
             logging.debug("Bootstrapping raw values, within groups defined by" + 
                          "'" + str(job.settings.block_variables) + "'")
             layout = job.block_layout
-        return random_indexes(layout, R)
+        return SampleIndexSpec.bootstrap(layout, R, seed)
 
     else:
         logging.debug("Creating max of {0} random permutations".format(R))
         logging.debug("Condition layout is " + str(job.condition_layout))
         logging.debug("Block layout is " + str(job.block_layout))
-        return list(random_orderings(job.condition_layout, job.block_layout, R))
+        return SampleIndexSpec.permutations(
+            job.condition_layout, job.block_layout, R, seed)
+
+def new_sample_indexes(job, seed=None):
+    """Create array of sample indexes."""
+    return new_sample_index_spec(job, seed)[:]
 
     
-def compute_mean_perm_count(job):
+def shard_range(n, shard, num_shards):
+    """Returns the (start, stop) range of the items in one shard.
+
+    Divides n items into num_shards contiguous shards whose sizes
+    differ by at most one.
+
+    >>> [ shard_range(10, i, 3) for i in range(3) ]
+    [(0, 3), (3, 6), (6, 10)]
+
+    """
+    start = n * shard // num_shards
+    stop  = n * (shard + 1) // num_shards
+    return (start, stop)
+
+def compute_perm_count(job, start=None, stop=None, inputs=None):
+    """Returns the total counts for a range of the permutations.
+
+    Unlike compute_mean_perm_count, the counts are summed rather than
+    averaged, so the counts for several ranges can simply be added
+    together. Supply inputs from perm_count_inputs to avoid computing
+    them again.
+
+    """
+    # Count the range without building it, since slicing a spec
+    # constructs the indexes.
+    num_perms = len(xrange(*slice(start, stop).indices(
+                len(job.results.sample_indexes))))
+    if num_perms == 0:
+        return np.zeros(cumulative_hist_shape(job.results.bins))
+    return compute_mean_perm_count(job, start, stop, inputs) * num_perms
+
+def adaptive_mean_perm_count(job, count_fn=None,
+                             interval=DEFAULT_STOP_CHECK_INTERVAL,
+                             checks=DEFAULT_STOP_CHECKS):
+    """Compute the mean permutation counts, stopping once the summary settles.
+
+    Runs the samples in rounds of interval samples. After each round
+    we compute the confidence scores from the mean counts so far, and
+    count the features at each of the summary's confidence levels. We
+    stop once those counts have been within job.settings.stop_tolerance
+    of the counts from the round before for checks rounds in a row, or
+    we run out of samples.
+
+    :param job:
+      The pade.model.Job, with its raw stats and bins computed.
+
+    :param count_fn:
+      A function of (start, stop) that returns the summed counts for
+      that range of the samples. Defaults to compute_perm_count for
+      the job, with the inputs computed once for all the rounds.
+
+    :param interval:
+      Number of samples to run in each round.
 
+    :param checks:
+      Number of round-to-round comparisons in a row that must settle
+      before we stop.
+
+    :return:
+      A pair of the mean permutation counts and the number of samples
+      they were computed from.
+
+    """
+    if count_fn is None:
+        inputs = perm_count_inputs(job)
+        count_fn = lambda start, stop: compute_perm_count(
+            job, start, stop, inputs)
+
+    raw  = job.results.raw_stats
+    bins = job.results.bins
+    unperm_counts = cumulative_hist(raw, bins)
+    conf_levels   = summary_conf_levels(job.settings)
+    num_samples   = len(job.results.sample_indexes)
+
+    total = np.zeros(cumulative_hist_shape(bins))
+    mean  = total
+    stop  = 0
+    last  = None
+    num_settled = 0
+
+    for start in range(0, num_samples, interval):
+        stop = min(start + interval, num_samples)
+        total += count_fn(start, stop)
+        mean = total / stop
+
+        scores = confidence_scores(unperm_counts, mean, np.shape(raw)[-1])
+        (ignore, counts) = conf_level_counts(
+            assign_scores_to_features(raw, bins, scores), conf_levels)
+        logging.info("Counts by confidence level after {0} samples: {1}".format(
+                stop, counts))
+
+        if (last is not None and
+            counts_settled(last, counts, job.settings.stop_tolerance)):
+            num_settled += 1
+        else:
+            num_settled = 0
+
+        if num_settled >= checks:
+            logging.info("Counts settled, stopping after {0} of {1} samples".format(
+                    stop, num_samples))
+            break
+        last = counts
+
+    return (mean, stop)
+
+PermCountInputs = namedtuple(
+    "PermCountInputs",
+    ["data", "residuals", "stat_fn"])
+
+def perm_count_inputs(job):
+    """Returns the PermCountInputs the samples for a job are drawn from.
+
+    These don't depend on which samples we run, so a caller that
+    counts the samples in several ranges can compute them once and
+    pass them to each compute_perm_count or compute_mean_perm_count.
+
+    """
     table = job.input.table
-    bins  = job.results.bins
-    perms = job.results.sample_indexes
     stat_fn = job.get_stat_fn()
 
     if job.settings.sample_from_residuals:
         prediction = predicted_values(job)
-        diffs      = table - prediction
-        return bootstrap(
-            prediction,
-            stat_fn, 
-            permutations=perms,
-            residuals=diffs,
-            bins=bins)
+        return PermCountInputs(prediction, table - prediction, stat_fn)
+
+    # Shift all values in the data by the means of the groups from
+    # the full model, so that the mean of each group is 0.
+    if not job.settings.equalize_means:
+        logging.info("Not equalizing means")
+        return PermCountInputs(table, None, stat_fn)
+
+    logging.info("Equalizing means")
+    shifted = residuals(table, job.full_layout)
+    if job.settings.equalize_means_ids is None:
+        return PermCountInputs(shifted, None, stat_fn)
+
+    data = np.zeros_like(table)
+    ids = list(job.settings.equalize_means_ids)
+    count = len(ids)
+    for i, fid in enumerate(job.input.feature_ids):
+        if fid in ids:
+            data[i] = shifted[i]
+            ids.remove(fid)
+        else:
+            data[i] = table[i]
+    logging.debug("Equalized means for " + str(count - len(ids)) + " features")
+    if len(ids) > 0:
+        logging.warn("There were " + str(len(ids)) + " feature " +
+                     "ids given that don't exist in the data: " +
+                     str(ids))
+    return PermCountInputs(data, None, stat_fn)
 
-    else:
-        # Shift all values in the data by the means of the groups from
-        # the full model, so that the mean of each group is 0.
-        if job.settings.equalize_means:
-            logging.info("Equalizing means")
-            shifted = residuals(table, job.full_layout)
-            data = np.zeros_like(table)
-            if job.settings.equalize_means_ids is None:
-                data = shifted
-            else:
-                ids = job.settings.equalize_means_ids
-                count = len(ids)
-                for i, fid in enumerate(job.input.feature_ids):
-                    if fid in ids:
-                        data[i] = shifted[i]
-                        ids.remove(fid)
-                    else:
-                        data[i] = table[i]
-                logging.debug("Equalized means for " + str(count - len(ids)) + " features")
-                if len(ids) > 0:
-                    logging.warn("There were " + str(len(ids)) + " feature " +
-                                 "ids given that don't exist in the data: " +
-                                 str(ids))
-
-            return bootstrap(data, stat_fn, permutations=perms,bins=bins)
+def compute_mean_perm_count(job, start=None, stop=None, inputs=None):
+    """Returns the mean counts for a range of the permutations.
 
-        else:
-            logging.info("Not equalizing means")
-            return bootstrap(table, stat_fn, permutations=perms,bins=bins)
+    Supply inputs from perm_count_inputs to avoid computing them
+    again.
+
+    """
+    if inputs is None:
+        inputs = perm_count_inputs(job)
+
+    return bootstrap(
+        inputs.data,
+        inputs.stat_fn,
+        permutations=job.results.sample_indexes[start : stop],
+        residuals=inputs.residuals,
+        bins=job.results.bins,
+        max_batch_bytes=job.settings.max_batch_bytes)
 
 
 def assignment_name(a):
@@ -387,7 +387,7 @@ class Poisson(Family):
             mask = Ymu != 0
             YmuMasked = Ymu[mask]
             Ymasked = Y[mask]
-            np.putmask(retarr, mask, Ymasked*np.log(YmuMasked)/scale)
+            retarr[mask] = Ymasked*np.log(YmuMasked)/scale
             return 2*np.sum(retarr, axis=-1)
         else:
             return 2*np.sum(Y*np.log(Y/mu), axis=-1)/scale
@@ -1,11 +1,12 @@
 from __future__ import print_function
 
+import logging
 import pade.family as fam
 import numpy as np
 from scipy.linalg import svdvals
 from collections import namedtuple
 
-GlmResults = namedtuple('GlmResults', ['beta', 'mu', 'weights', 'normalized_cov_params', 'scale'])
+GlmResults = namedtuple('GlmResults', ['beta', 'mu', 'weights', 'normalized_cov_params', 'scale', 'iterations'])
 
 def f_test_two_cond(betas, cov_ps, smoothing=0.0):
     """Special case of the f-test for when r_matrix is [ [ 0, 1 ] ].
@@ -33,46 +34,33 @@ def f_test(betas, r_matrix, cov_ps, scale, smoothing=0.0):
     if scale is None:
         scale = np.ones(len(betas))
 
-    F = None
-    i = 0
-
     scale = np.reshape(scale, (len(scale), 1, 1))
     scaled_cov_ps = cov_ps * scale
 
     if np.shape(r_matrix) == (1, 2) and r_matrix[0, 0] == 0 and r_matrix[0, 1] == 1:
         return f_test_two_cond(betas, scaled_cov_ps, smoothing)
 
-    for beta, cov_p in zip(betas, scaled_cov_ps):
-        
-        Rbq = np.dot(r_matrix, beta[:, None])
-        
-        if np.shape(smoothing) is ():
-            cov = r_matrix.dot((cov_p + smoothing).dot(r_matrix.T))
-
-            invcov = np.linalg.inv(cov)
-
-            res = np.dot(np.dot(Rbq.T, invcov), Rbq)
-
-            if F is None:
-                F = np.zeros((len(betas),) + res.shape)
-            F[i] = res
-
-        else:
-            for j, a in enumerate(smoothing):
-                cov = r_matrix.dot((cov_p + a).dot(r_matrix.T))
-
-                invcov = np.linalg.inv(cov)
+    r_matrix = np.asarray(r_matrix, float)
 
-                res = np.dot(np.dot(Rbq.T, invcov), Rbq)
+    # Smoothing adds a constant to every element of the covariance
+    # matrix, so R (C + a) R' = R C R' + a (R 1) (R 1)'. That lets us
+    # do the part that depends on the features once, and just add on
+    # a multiple of the same matrix for each smoothing value.
+    Rbq = np.dot(betas, r_matrix.T)
+    cov = np.matmul(np.matmul(r_matrix, scaled_cov_ps), r_matrix.T)
+    r_sums = np.sum(r_matrix, axis=1)
+    smoothing_cov = np.outer(r_sums, r_sums)
 
-                if F is None:
-                    F = np.zeros((len(smoothing), len(betas),) + res.shape)
-                F[j, i] = res
+    alphas = np.reshape(smoothing, np.shape(smoothing) + (1, 1, 1))
+    cov = cov + alphas * smoothing_cov
 
-        i += 1
+    # Solve all the systems at once, giving Rbq' inv(cov) Rbq for each
+    # feature and smoothing value.
+    Rbq = np.broadcast_to(Rbq, np.shape(cov)[:-1])
+    F = np.sum(Rbq * np.linalg.solve(cov, Rbq[..., np.newaxis])[..., 0], axis=-1)
 
     J = float(r_matrix.shape[0])  # number of restrictions
-    return F / J
+    return F.reshape(F.shape + (1, 1)) / J
 
 def estimate_scale(mu, family, endog, scaletype=None, df_resid=None):
     """
@@ -154,55 +142,94 @@ def fit_glm(endog, exog, family=None, maxiter=100, tol=1e-8, scaletype=None):
 
     :param scale:
 
+    :return:
+      a GlmResults. Each row of endog stops iterating once both its
+      deviance and its linear predictor stop changing, so iterations
+      gives the number of IRLS iterations used for each row.
+
+    A row whose deviance has converged but whose linear predictor is
+    still moving, as when one group is all zeros for Poisson or
+    negative binomial and its coefficient heads off to infinity,
+    isn't dropped on its own. Its statistic depends on when we stop,
+    so it keeps iterating until the deviance of every row still being
+    fit converges at once, the same point at which fitting all the
+    rows together would stop.
+
     '''
 
-    exog = np.array([ exog for x in endog ])
+    exog = np.asarray(exog, float)
 
     mu  = family.starting_mu(endog)
     eta = family.predict(mu)
     dev = family.deviance(endog, mu)
 
-    for x in dev:
-        if np.isnan(x):
-            raise ValueError("The first guess on the deviance function "
-                             "returned a nan.  This could be a boundary "
-                             " problem and should be reported.")
+    if np.any(np.isnan(dev)):
+        raise ValueError("The first guess on the deviance function "
+                         "returned a nan.  This could be a boundary "
+                         " problem and should be reported.")
+
+    df_resid = exog.shape[0] - rank(exog)
+
+    (num_models, num_regressors) = (len(endog), exog.shape[1])
+    beta    = np.zeros((num_models, num_regressors))
+    normalized_cov_params = np.zeros((num_models, num_regressors, num_regressors))
+    weights = np.zeros(np.shape(endog))
+
+    # Number of iterations each model took to converge
+    iterations = np.zeros(num_models, int)
+
+    # Indexes of the models that haven't converged yet. We only refit
+    # those on each iteration.
+    active = np.arange(num_models)
 
     iteration = 0
-    converged = 0
+    all_converged = False
 
-    deviance = [ np.inf, dev ]
+    while len(active) > 0:
 
-    df_resid = exog.shape[1] - rank(exog[0])
+        y = endog[active]
+        m = mu[active]
+        old_eta = eta[active]
 
-    while not converged:
+        w = family.weights(m)
+        wlsendog = eta[active] + family.link.deriv(m) * (y - m)
+        (b, cov_p) = fit_wls(wlsendog, exog, w)
 
-        weights  = family.weights(mu)
-        wlsendog = eta + family.link.deriv(mu) * (endog - mu)
-        (beta, normalized_cov_params) = fit_wls(wlsendog, exog, weights)
+        beta[active] = b
+        normalized_cov_params[active] = cov_p
+        weights[active] = w
+        eta[active] = np.dot(b, exog.T)
+        mu[active]  = family.fitted(eta[active])
 
-        for i in range(len(eta)):
-            eta[i] = np.dot(exog[i], beta[i])
+        new_dev = family.deviance(y, mu[active])
+        converged = np.fabs(new_dev - dev[active]) <= tol
+        settled = converged & (
+            np.max(np.fabs(eta[active] - old_eta), axis=-1) <= np.sqrt(tol))
+        dev[active] = new_dev
 
-        mu = family.fitted(eta)
-        deviance.append(family.deviance(endog, mu))
-        scale = estimate_scale(mu, family=family, endog=endog, scaletype=scaletype, df_resid=df_resid)
+        iterations[active] += 1
         iteration += 1
 
         if endog.squeeze().ndim == 1 and np.allclose(mu - endog, 0):
             msg = "Perfect separation detected, results not available"
             raise PerfectSeparationError(msg)
 
-        converged = _check_convergence(deviance, iteration, tol, maxiter)
+        if iteration > maxiter or all_converged:
+            break
 
-    return GlmResults(beta, mu, weights, normalized_cov_params, scale)
+        # Fitting all the rows together checked the deviances from one
+        # iteration back, so it fit once more after every row's
+        # deviance converged. Do the same for the rows that are left.
+        all_converged = np.all(converged)
+        active = active[~settled]
 
+    logging.debug("Fit {0} GLMs in at most {1} iterations".format(
+            num_models, np.max(iterations) if num_models else 0))
+
+    scale = estimate_scale(mu, family=family, endog=endog, scaletype=scaletype, df_resid=df_resid)
+
+    return GlmResults(beta, mu, weights, normalized_cov_params, scale, iterations)
 
-# TODO: I think I need to fix this.
-def _check_convergence(criterion, iteration, tol, maxiter):
-    
-    delta = np.fabs(criterion[iteration] - criterion[iteration-1])
-    return np.all(delta <= tol) or iteration > maxiter
 
 def whiten(weights, X):
     """
@@ -232,29 +259,49 @@ def fit_wls(endog, exog, weights=1.):
     """
     Full fit of the model.
 
+    Solves the weighted least squares problem for every row of endog
+    at once, using the normal equations. Falls back to the
+    pseudo-inverse if any of the systems are singular.
+
     :return: 
       a 2-tuple with the parameters and the estimated covariance
       matrix.
 
     :param endog:
-      the 2-d endogenous matrix
+      the 2-d endogenous matrix, with one row per model
 
     :param exog:
-      the 2-d exogenous matrix
+      the exogenous matrix, either 2-d and shared by all the models,
+      or 3-d with one matrix per model
+
+    :param weights:
+      the weights, either a scalar or the same shape as endog
 
     """
-    
-    wexog  = whiten(weights, exog)
-    wendog = whiten(weights, endog)
+    endog   = np.asarray(endog, float)
+    exog    = np.asarray(exog, float)
+    weights = np.broadcast_to(weights, np.shape(endog))
+
+    # X'WX and X'Wy for each model. When exog is shared, X'WX is a
+    # weighted sum of the outer products of the rows of exog, which
+    # we can get with a single matrix product.
+    if exog.ndim == 2:
+        (n_obs, n_regressors) = exog.shape
+        outer = (exog[:, :, np.newaxis] * exog[:, np.newaxis, :])
+        xtwx = np.dot(weights, outer.reshape((n_obs, -1)))
+        xtwx = xtwx.reshape(np.shape(weights)[:-1] + (n_regressors, n_regressors))
+        xtwy = np.dot(weights * endog, exog)
+    else:
+        wexog = weights[..., np.newaxis] * exog
+        xtwx = np.einsum('...nk,...nl->...kl', wexog, exog)
+        xtwy = np.einsum('...nk,...n->...k', wexog, endog)
 
-    (n_models, n_obs, n_regressors) = wexog.shape
-    normalized_cov_params = np.zeros((n_models, n_regressors, n_regressors))
-    beta = np.zeros((n_models, n_regressors))
+    try:
+        normalized_cov_params = np.linalg.inv(xtwx)
+    except np.linalg.LinAlgError:
+        normalized_cov_params = np.array([ np.linalg.pinv(a) for a in xtwx ])
 
-    for i in range(len(wexog)):
-        pinv_wexog = np.linalg.pinv(wexog[i])
-        normalized_cov_params[i] = np.dot(pinv_wexog, pinv_wexog.T)
-        beta[i] = np.dot(pinv_wexog, wendog[i])
+    beta = np.matmul(normalized_cov_params, xtwy[..., np.newaxis])[..., 0]
 
     return (beta, normalized_cov_params)
 
@@ -1,21 +1,26 @@
 from __future__ import absolute_import, print_function, division
 
-import matplotlib
-matplotlib.use("Agg")
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from matplotlib.ticker import FuncFormatter
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pade.tasks 
 import logging
+import os
+import errno
+import hashlib
+import shutil
 
 from flask import Blueprint, render_template, request, make_response, send_file, abort
 from celery.result import AsyncResult
-from bisect import bisect
-from pade.stat import cumulative_hist, adjust_num_diff, GLMFStat
+from pade.stat import cumulative_hist, adjust_num_diff, GLMFStat, ScoreLookup
 from StringIO import StringIO
 from pade.metadb import JobMeta
 from functools import wraps
+from collections import OrderedDict
+from threading import Lock, current_thread
+from datetime import datetime
 from pade.analysis import assignment_name
 
 bp = Blueprint(
@@ -26,26 +31,286 @@ mdb = None
 
 job_dbs = []
 
+DEFAULT_JOB_CACHE_BYTES = 512 * 1024 * 1024
+"""Memory the job cache may use for datasets it has read."""
+
+class JobCache(object):
+    """Keeps recently used jobs in memory between requests.
+
+    Jobs are opened lazily, so each one only holds the datasets that
+    views have actually used. When the datasets held by all the jobs
+    take more than max_bytes, the least recently used jobs are
+    dropped. A job is reloaded if its file has changed since we
+    loaded it, like when the job is still running.
+
+    """
+    def __init__(self, max_bytes=DEFAULT_JOB_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.jobs = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, path):
+        """Returns the job at the given path, loading it if necessary."""
+
+        stat = os.stat(path)
+        version = (stat.st_mtime, stat.st_size)
+
+        with self.lock:
+            (cached_version, job) = self.jobs.pop(path, (None, None))
+
+        if cached_version != version:
+            logging.info("Loading job " + path + " into the job cache")
+            # Don't hold the file open: a running job writes to it from another process.
+            job = pade.tasks.open_job(path)
+            job.close()
+
+        with self.lock:
+            self.jobs[path] = (version, job)
+
+        return job
+
+    def trim(self):
+        """Drop the least recently used jobs until we're within max_bytes,
+        always keeping the most recent one."""
+        with self.lock:
+            sizes = [ pade.tasks.loaded_nbytes(job) for (v, job) in self.jobs.values() ]
+            total = sum(sizes)
+            for (path, size) in zip(list(self.jobs), sizes[:-1]):
+                if total <= self.max_bytes:
+                    break
+                logging.info("Dropping job " + path + " from the job cache")
+                del self.jobs[path]
+                total -= size
+
+    def clear(self):
+        with self.lock:
+            self.jobs.clear()
+
+job_cache = JobCache()
+
+MAX_SCATTER_FEATURES = 20000
+"""Largest number of features we draw individually in the mean vs
+variance plot. Larger jobs are drawn as a hexbin density plot."""
+
+HEXBIN_GRID_SIZE = 50
+"""Number of hexagons across the mean vs variance density plot."""
+
+plot_cache_dir = None
+"""Directory to save rendered plots in when we don't have a MetaDB.
+
+If this is None and there is no MetaDB, plots are rendered on every
+request that the browser doesn't already have a copy of.
+
+"""
+
+DEFAULT_PLOT_CACHE_BYTES = 256 * 1024 * 1024
+"""Disk space the plot cache may use for rendered plots."""
+
+ALL_JOBS_PLOT_DIR = 'all_jobs'
+"""Subdirectory of the plot cache for plots drawn from all the jobs."""
+
+class PlotCache(object):
+    """Keeps rendered plots on disk between requests.
+
+    The plots for each job are kept in their own subdirectory of the
+    cache directory, named for the job's path, so that they can be
+    removed once the job is gone. Reading a plot marks it as recently
+    used by updating its modification time. When the plots take more
+    than max_bytes, the least recently used ones are removed.
+
+    """
+    def __init__(self, max_bytes=DEFAULT_PLOT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+
+    @staticmethod
+    def job_dir(cache_dir, path):
+        """Returns the directory holding the plots for the job at path."""
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        return os.path.join(cache_dir, hashlib.sha1(path).hexdigest())
+
+    def read(self, plot_path):
+        """Returns the cached plot at plot_path, or None if there isn't one."""
+        try:
+            with open(plot_path, 'rb') as cached:
+                png = cached.read()
+            os.utime(plot_path, None)
+            return png
+        except (IOError, OSError) as e:
+            return None
+
+    def save(self, plot_path, png):
+        """Save a rendered plot, so other requests never see part of it."""
+        try:
+            os.makedirs(os.path.dirname(plot_path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise e
+
+        tmp_path = "{0}.{1}.{2}.tmp".format(plot_path, os.getpid(), current_thread().ident)
+        with open(tmp_path, 'wb') as out:
+            out.write(png)
+        os.rename(tmp_path, plot_path)
+
+    def trim(self, cache_dir, job_paths):
+        """Remove plots until we're within max_bytes.
+
+        Plots for jobs that aren't in job_paths any more are removed
+        first, then the least recently used plots.
+
+        """
+        with self.lock:
+            keep = set([ os.path.basename(self.job_dir(cache_dir, path))
+                         for path in job_paths ])
+            keep.add(ALL_JOBS_PLOT_DIR)
+
+            try:
+                subdirs = os.listdir(cache_dir)
+            except OSError as e:
+                return
+
+            plots = []
+            for name in subdirs:
+                subdir = os.path.join(cache_dir, name)
+                if name not in keep:
+                    logging.info("Removing plots for a job that's gone: " + name)
+                    if os.path.isdir(subdir):
+                        shutil.rmtree(subdir, ignore_errors=True)
+                    else:
+                        self._remove(subdir)
+                    continue
+
+                try:
+                    names = os.listdir(subdir)
+                except OSError as e:
+                    continue
+
+                for name in names:
+                    # Leave plots that are still being written alone
+                    if name.endswith('.tmp'):
+                        continue
+                    plot_path = os.path.join(subdir, name)
+                    try:
+                        stat = os.stat(plot_path)
+                    except OSError as e:
+                        continue
+                    plots.append((stat.st_mtime, stat.st_size, plot_path))
+
+            plots.sort()
+            total = sum(size for (mtime, size, plot_path) in plots)
+            for (mtime, size, plot_path) in plots:
+                if total <= self.max_bytes:
+                    break
+                self._remove(plot_path)
+                total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            pass
+
+plot_cache = PlotCache()
+
+def get_job_meta(job_id):
+    job_id = int(job_id)
+    if mdb is not None:
+        return mdb.job(job_id)
+    else:
+        return job_dbs[job_id]
+
 def job_context(f):
     @wraps(f)
     def decorated(*args, **kwargs):
 
-        job_id = int(kwargs['job_id'])
-        if mdb is not None:
-            job_meta = mdb.job(job_id)
-        else:
-            job_meta = job_dbs[job_id]
+        job_meta = get_job_meta(kwargs['job_id'])
         kwargs['job_meta'] = job_meta
+
         try:
-            kwargs['job_db']   = pade.tasks.load_job(job_meta.path)
-        except IOError as e:
+            kwargs['job_db'] = job_cache.get(job_meta.path)
+        except (IOError, OSError) as e:
             kwargs['job_db'] = None
 
         del kwargs['job_id']
-        return f(*args, **kwargs)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            job_cache.trim()
     return decorated
     
 
+def cached_plot(all_jobs=False):
+    """Decorator for views that render a plot of a job.
+
+    Plots are identified by the view, its arguments, the query string,
+    and the modification time and size of the job files they're drawn
+    from. The identifier is sent as the ETag, so browsers that already
+    have the plot get a 304 response, and the rendered PNG is saved in
+    the plot cache so other requests for it just read the file.
+
+    :param all_jobs:
+      Whether the plot is drawn from all the jobs, rather than just
+      the one named by the job_id argument.
+
+    """
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+
+            if all_jobs:
+                paths = [ jm.path for jm in all_job_metas() ]
+            else:
+                paths = [ get_job_meta(kwargs['job_id']).path ]
+
+            versions = []
+            for path in paths:
+                try:
+                    stat = os.stat(path)
+                    versions.append((path, stat.st_mtime, stat.st_size))
+                except OSError as e:
+                    versions.append((path, None, None))
+
+            key = repr((f.__name__,
+                        sorted(kwargs.items()),
+                        sorted(request.args.items(multi=True)),
+                        versions))
+            etag = hashlib.sha1(key).hexdigest()
+            mtimes = [ mtime for (path, mtime, size) in versions if mtime is not None ]
+
+            cache_dir = mdb.plot_cache_dir if mdb is not None else plot_cache_dir
+            cache_path = None
+            png = None
+
+            if cache_dir is not None:
+                if all_jobs:
+                    job_dir = os.path.join(cache_dir, ALL_JOBS_PLOT_DIR)
+                else:
+                    job_dir = plot_cache.job_dir(cache_dir, paths[0])
+                cache_path = os.path.join(job_dir, etag + '.png')
+                png = plot_cache.read(cache_path)
+
+            if png is None:
+                response = f(*args, **kwargs)
+                if (response.status_code != 200 or 
+                    response.mimetype != 'image/png'):
+                    return response
+                png = response.data
+                if cache_path is not None:
+                    plot_cache.save(cache_path, png)
+                    plot_cache.trim(
+                        cache_dir, [ jm.path for jm in all_job_metas() ])
+
+            response = make_response(png)
+            response.headers['Content-Type'] = 'image/png'
+            response.set_etag(etag)
+            if mtimes:
+                response.last_modified = datetime.utcfromtimestamp(max(mtimes))
+            return response.make_conditional(request)
+        return decorated
+    return decorator
+
 def load_job(job_id):
     """Load the Job object with the given meta job id."""
     job_meta = get_job_meta(job_id)
@@ -183,9 +448,11 @@ def feature(job_meta, job_db, feature_num):
 
     stats           = job_db.results.raw_stats[..., feature_num]
     params          = job_db.settings.tuning_params
-    bins            = np.array([ bisect(job_db.results.bins[i], stats[i]) - 1 for i in range(len(params)) ])
-    unperm_count    = np.array([ job_db.results.bin_to_unperm_count[i, bins[i]] for i in range(len(params))])
-    mean_perm_count = np.array([ job_db.results.bin_to_mean_perm_count[i, bins[i]] for i in range(len(params))])
+    lookup          = ScoreLookup(job_db.results.bins, job_db.results.bin_to_score)
+    bins            = lookup.bin_indexes(stats[..., np.newaxis])[..., 0]
+    param_idxs      = np.arange(len(params))
+    unperm_count    = job_db.results.bin_to_unperm_count[param_idxs, bins]
+    mean_perm_count = job_db.results.bin_to_mean_perm_count[param_idxs, bins]
     adjusted        = np.array(adjust_num_diff(mean_perm_count, unperm_count, len(job_db.input.table)))
     new_scores      = (unperm_count - adjusted) / unperm_count
     max_stat        = job_db.results.bins[..., -2]
@@ -218,6 +485,7 @@ def feature(job_meta, job_db, feature_num):
         **kwargs)
 
 @bp.route("/jobs/<job_id>/features/<feature_num>/measurement_scatter")
+@cached_plot()
 @job_context
 def measurement_scatter(job_meta, job_db, feature_num):
     job = job_db
@@ -225,9 +493,10 @@ def measurement_scatter(job_meta, job_db, feature_num):
     schema = job.schema
     measurements = job.input.table[feature_num]
 
-    plt.title('Measurements')
-    plt.xlabel('Group')
-    plt.ylabel('Measurement')
+    (fig, ax) = new_figure()
+    ax.set_title('Measurements')
+    ax.set_xlabel('Group')
+    ax.set_ylabel('Measurement')
 
     assignments = schema.possible_assignments(job.full_variables)
     names = [assignment_name(a) for a in assignments]
@@ -237,60 +506,65 @@ def measurement_scatter(job_meta, job_db, feature_num):
 
         y = measurements[grps[i]]
         x = [i for j in y]
-        plt.scatter(x, y)
+        ax.scatter(x, y)
 
-    plt.xticks(np.arange(len(names)), 
-               names,
-               rotation=70
-               )
+    ax.set_xticks(np.arange(len(names)))
+    ax.set_xticklabels(names, rotation=70)
 
-    return figure_response()
+    return figure_response(fig)
 
 
 @bp.route("/jobs/<job_id>/mean_vs_variance")
+@cached_plot()
 @job_context
 def mean_vs_variance(job_meta, job_db):
     job   = job_db
-    means = np.mean(job.input.table, axis=-1)
-    var   = np.var(job.input.table, axis=-1)
+    means = job.results.feature_means
+    var   = job.results.feature_variances
+
+    # Jobs run before we saved the means and variances
+    if means is None or var is None:
+        means = np.mean(job.input.table, axis=-1)
+        var   = np.var(job.input.table, axis=-1)
 
     color = request.args.get('color')
     if color is None:
         color = 'score'
 
-
     if color == 'score':
+        colors = job.results.feature_best_score
+        if colors is None:
+            colors = np.max(job.results.feature_to_score, axis=0)
 
-        idxs = np.argmax(job_db.results.feature_to_score, axis=0)
+    elif color == 'stat':
+        colors = job.results.raw_stats[0]
 
-        best_score = np.zeros((len(means)))
+    mode = request.args.get('mode')
+    if mode is None:
+        mode = 'scatter' if len(means) <= MAX_SCATTER_FEATURES else 'hexbin'
 
-        for i in range(len(job.input.table)):
-            idx = idxs[i]
-            score = job.results.feature_to_score[idx, i]
-            best_score[i] = score
-        colors = best_score
+    (fig, ax) = new_figure()
+    top = min(np.max(means), np.max(var))
+    ax.plot([0, top], [0, top])
 
-    elif color == 'stat':
-        colors = job.results.raw_stats[0]
+    ax.set_title('Mean vs variance (' + str(job_meta.name) + ")")
+    ax.set_xlabel('Mean')
+    ax.set_ylabel('Variance')
 
-    min_val = min(min(means), min(var))
-    max_val = max(max(means), max(var))
-    
-    x = np.arange(min(max(means), max(var)))
-    plt.plot(x, x)
+    if mode == 'hexbin':
+        points = ax.hexbin(means, var, C=colors, reduce_C_function=np.mean,
+                           gridsize=HEXBIN_GRID_SIZE)
+    elif mode == 'scatter':
+        points = ax.scatter(means, var, c=colors)
+    else:
+        abort(404)
 
-#    plt.xlim((min_val, max_val))
-#    plt.ylim((min_val, max_val))
-    plt.title('Mean vs variance (' + str(job_meta.name) + ")")
-    plt.xlabel('Mean')
-    plt.ylabel('Variance')
-    plt.scatter(means, var, c=colors)
-    plt.colorbar()
-    return figure_response()
+    fig.colorbar(points, ax=ax)
+    return figure_response(fig)
 
 
 @bp.route("/jobs/<job_id>/features/<feature_num>/interaction_plot")
+@cached_plot()
 @job_context
 def interaction_plot(job_meta, job_db, feature_num):
     job = job_db
@@ -308,7 +582,8 @@ def interaction_plot(job_meta, job_db, feature_num):
 
     ticks = schema.factor_values[x_var]
 
-    plt.ylabel('Measurement')
+    (fig, ax) = new_figure()
+    ax.set_ylabel('Measurement')
     
     for series_name in schema.factor_values[series_var]:
         y = []
@@ -321,21 +596,20 @@ def interaction_plot(job_meta, job_db, feature_num):
             y.append(np.mean(values))
             yerr.append(np.std(values))
 
-        plt.errorbar(x=np.arange(len(ticks)), y=y, yerr=yerr, label=series_name)
+        ax.errorbar(x=np.arange(len(ticks)), y=y, yerr=yerr, label=series_name)
 
     margin = 0.25
 
-    plt.xlim(( 0 - margin, len(ticks) - 1 + margin))
-    plt.xticks(np.arange(len(ticks)))
-    fig, ax = plt.subplots()
-
+    ax.set_xlim(( 0 - margin, len(ticks) - 1 + margin))
+    ax.set_xticks(np.arange(len(ticks)))
     ax.set_xticklabels(ticks)
-    plt.legend()
-    plt.xlabel(x_var)
-    return figure_response()
+    ax.legend()
+    ax.set_xlabel(x_var)
+    return figure_response(fig)
 
 
 @bp.route("/jobs/<job_id>/features/<feature_num>/measurement_bars")
+@cached_plot()
 @job_context
 def measurement_bars(job_meta, job_db, feature_num):
     job = job_db
@@ -347,8 +621,9 @@ def measurement_bars(job_meta, job_db, feature_num):
     if 'variable' in request.args:
         variables = [ request.args.get('variable') ]
 
-    plt.title('Measurements for feature ' + job.input.feature_ids[feature_num] + " by " + ", ".join(variables))
-    plt.ylabel('Measurement')
+    (fig, ax) = new_figure()
+    ax.set_title('Measurements for feature ' + job.input.feature_ids[feature_num] + " by " + ", ".join(variables))
+    ax.set_ylabel('Measurement')
     
     assignments = schema.possible_assignments(variables)
 
@@ -360,10 +635,11 @@ def measurement_bars(job_meta, job_db, feature_num):
     names = [", ".join(map(str, a.values())) for a in assignments]
     y = [ np.mean(measurements[g]) for g in grps]
     err = [ np.std(measurements[g]) for g in grps]
-    plt.bar(x, y, yerr=err, color='y')
-    plt.xticks(x+width/2., names, rotation=70)
+    ax.bar(x, y, yerr=err, color='y')
+    ax.set_xticks(x+width/2.)
+    ax.set_xticklabels(names, rotation=70)
 
-    return figure_response()
+    return figure_response(fig)
 
 
 @bp.route("/jobs/<job_id>/stat_dist")
@@ -390,6 +666,7 @@ def confidence_dist(job_id):
                            job_id=job_id)
 
 @bp.route("/jobs/<job_id>/stat_dist/<tuning_param>.png")
+@cached_plot()
 @job_context
 def stat_dist_plot(job_meta, job_db, tuning_param):
 
@@ -397,34 +674,35 @@ def stat_dist_plot(job_meta, job_db, tuning_param):
     tuning_param = int(tuning_param)
     title = job_db.settings.stat + " distribution over features, $\\alpha = " + str(tuning_param) + "$"
 
-    plt.title(title)
-    plt.xlabel(job_db.settings.stat + " value")
-    plt.ylabel("Features")
-    plt.xlim((0, max_stat))
-    plt.hist(job_db.results.raw_stats[tuning_param], log=False, bins=250)
-    return figure_response()
+    (fig, ax) = new_figure()
+    ax.set_title(title)
+    ax.set_xlabel(job_db.settings.stat + " value")
+    ax.set_ylabel("Features")
+    ax.set_xlim((0, max_stat))
+    ax.hist(job_db.results.raw_stats[tuning_param], log=False, bins=250)
+    return figure_response(fig)
 
 @bp.route("/jobs/<job_id>/bin_to_score.png")
+@cached_plot()
 @job_context
 def bin_to_score_plot(job_meta, job_db):
     data = job_db.results.bin_to_score
-    fig = plt.figure()
-    ax = fig.add_subplot(
-        111,
-        title="Confidence by stat value value",
-        xlabel="Statistic value",
-        ylabel="Confidence")
+    (fig, ax) = new_figure()
+    ax.set_title("Confidence by stat value value")
+    ax.set_xlabel("Statistic value")
+    ax.set_ylabel("Confidence")
 
     for i, param in enumerate(job_db.settings.tuning_params):
-        plt.plot(job_db.results.bins[i, :-1], data[i], label=str(param))
+        ax.plot(job_db.results.bins[i, :-1], data[i], label=str(param))
 
     if request.args.get('semilogx') == 'True':
-        plt.semilogx(base=10)
-    plt.legend(loc='lower right')
+        ax.set_xscale('log', basex=10)
+    ax.legend(loc='lower right')
 
-    return figure_response()
+    return figure_response(fig)
 
 @bp.route("/jobs/<job_id>/bin_to_features.png")
+@cached_plot()
 @job_context
 def bin_to_features_plot(job_meta, job_db):
 
@@ -432,59 +710,68 @@ def bin_to_features_plot(job_meta, job_db):
     if 'tuning_param_idx' in request.args:
         params = [ params[int(request.args.get('tuning_param_idx'))] ]
 
-    plt.title('Features count by statistic value')
-    plt.xlabel('Statistic value')
-    plt.ylabel('Features')
+    (fig, ax) = new_figure()
+    ax.set_title('Features count by statistic value')
+    ax.set_xlabel('Statistic value')
+    ax.set_ylabel('Features')
 
     for i, param in enumerate(params):
-        plt.plot(job_db.results.bins[i, :-1], job_db.results.bin_to_mean_perm_count[i], '--', label=str(param) + " permuted")
-        plt.plot(job_db.results.bins[i, :-1], job_db.results.bin_to_unperm_count[i], label=str(param) + " unpermuted")
+        ax.plot(job_db.results.bins[i, :-1], job_db.results.bin_to_mean_perm_count[i], '--', label=str(param) + " permuted")
+        ax.plot(job_db.results.bins[i, :-1], job_db.results.bin_to_unperm_count[i], label=str(param) + " unpermuted")
     if request.args.get('semilogx') == 'True':
-        plt.semilogx(base=10)
-    plt.legend(loc='upper right')
-    return figure_response()
+        ax.set_xscale('log', basex=10)
+    ax.legend(loc='upper right')
+    return figure_response(fig)
 
 def max_features_found():
     counts = []
     for jm in all_job_metas():
-        jdb = pade.tasks.load_job(jm.path)
-        counts.append(max(jdb.summary.counts))
+        summary = pade.tasks.load_summary_index(jm.path)
+        if summary is not None:
+            counts.append(max(summary.counts))
     return max(counts)
 
 @bp.route("/jobs/<job_id>/conf_dist")
+@cached_plot(all_jobs=True)
 @job_context
 def conf_dist_plot(job_meta, job_db):
     max_count = max_features_found()
 
-    plt.title("Feature count by confidence score")
-    plt.xlabel("Confidence score")
-    plt.ylabel("Features")
-    plt.plot(job_db.summary.bins, job_db.summary.counts)
-    plt.ylim((0, max_count))
-    return figure_response()
+    (fig, ax) = new_figure()
+    ax.set_title("Feature count by confidence score")
+    ax.set_xlabel("Confidence score")
+    ax.set_ylabel("Features")
+    ax.plot(job_db.summary.bins, job_db.summary.counts)
+    ax.set_ylim((0, max_count))
+    return figure_response(fig)
 
 
 @bp.route("/conf_dist")
+@cached_plot(all_jobs=True)
 def all_conf_dist_plot():
 
-    plt.title("Feature count by confidence score")
-    plt.xlabel("Confidence score")
-    plt.ylabel("Features")
+    (fig, ax) = new_figure()
+    ax.set_title("Feature count by confidence score")
+    ax.set_xlabel("Confidence score")
+    ax.set_ylabel("Features")
 
     for jm in all_job_metas():
-        jdb = pade.tasks.load_job(jm.path)
-        plt.plot(jdb.summary.bins, jdb.summary.counts, label=jm.name)
-    plt.legend(loc='upper right')
-    return figure_response()
+        summary = pade.tasks.load_summary_index(jm.path)
+        if summary is not None:
+            ax.plot(summary.bins, summary.counts, label=jm.name)
+    ax.legend(loc='upper right')
+    return figure_response(fig)
     
 
 @bp.route("/jobs/<job_id>/score_dist_for_tuning_params.png")
+@cached_plot()
 @job_context
 def score_dist_by_tuning_param(job_meta, job_db):
 
-    plt.title('Features by confidence score')
-    plt.xlabel('Confidence')
-    plt.ylabel('Features')
+    (fig, ax) = new_figure()
+    ax.set_title('Features by confidence score')
+    ax.set_xlabel('Confidence')
+    ax.set_ylabel('Features')
 
     lines = []
     labels = []
@@ -496,18 +783,28 @@ def score_dist_by_tuning_param(job_meta, job_db):
     for i, alpha in enumerate(params):
         bins = np.arange(0.5, 1.0, 0.01)
         hist = cumulative_hist(job_db.results.feature_to_score[i], bins)
-        lines.append(plt.plot(bins[:-1], hist, label=str(alpha)))
+        lines.append(ax.plot(bins[:-1], hist, label=str(alpha)))
         labels.append(str(alpha))
-    plt.legend(loc='upper right')
+    ax.legend(loc='upper right')
+
+    return figure_response(fig)
+
+
+def new_figure():
+    """Returns a new figure with a single set of axes.
 
-    return figure_response()
+    Views draw on their own figure rather than through pyplot's
+    current figure, so requests can be rendered concurrently.
 
+    """
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    return (fig, fig.add_subplot(111))
 
-def figure_response():
+def figure_response(fig):
     """Turns a matplotlib figure into an HTTP response."""
     png_output = StringIO()
-    plt.savefig(png_output)
-    plt.clf()
+    fig.canvas.print_png(png_output)
     response = make_response(png_output.getvalue())
     response.headers['Content-Type'] = 'image/png'
     return response
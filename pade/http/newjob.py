@@ -434,7 +434,8 @@ def submit_job():
         settings=wf.settings,
         sample_indexes_path=None,
         path=os.path.abspath(job_meta.path),
-        job_id=job_meta.obj_id)
+        job_id=job_meta.obj_id,
+        input_cache_dir=mdb.input_cache_dir)
 
     chained = celery.chain(steps)
     result = chained.apply_async()
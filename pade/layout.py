@@ -19,6 +19,7 @@ represented as lists, tuples, or sets.
 
 from __future__ import absolute_import, print_function, division
 
+import json
 import numpy as np
 from itertools import combinations, product
 from scipy.misc import comb
@@ -126,7 +127,7 @@ def num_orderings(condition_layout, block_layout=None):
         # number of orderings for the rest of the groups.
         N = sum(map(len, condition_layout))
         k   = len(condition_layout[0])
-        return comb(N, k) * num_orderings(condition_layout[1:])
+        return comb(N, k, exact=True) * num_orderings(condition_layout[1:])
 
     # Since we got a block layout, we need to find the number of
     # orderings *within* the first group in the block layout, then
@@ -174,7 +175,7 @@ def all_orderings_within_group(items, sizes):
      [2, 3, 0, 1]]
     
     """
-    items = set(items)
+    items = sorted(set(items))
     if len(items) != sum(sizes):
         raise InvalidLayoutException("Layout is bad, because length of items " +
                                      "does not equal sizes. Layout is " + 
@@ -185,7 +186,7 @@ def all_orderings_within_group(items, sizes):
             yield c
         else:
             for arr in all_orderings_within_group(
-                items.difference(c), sizes[1:]):
+                set(items).difference(c), sizes[1:]):
                 yield c + arr
 
 def all_orderings(condition_layout, block_layout):
@@ -203,12 +204,8 @@ def all_orderings(condition_layout, block_layout):
     ordering preserves the grouping defined by block layout.
       
     """
-    grouped = []
-    for i, block in enumerate(as_layout(block_layout)):
-
-        cond_groups = intersect_layouts([ block ], condition_layout )
-        sizes = map(len, cond_groups)
-        grouped.append(all_orderings_within_group(set(block), sizes))
+    grouped = [ all_orderings_within_group(items, sizes)
+                for (items, sizes) in block_groups(condition_layout, block_layout) ]
 
     for prod in product(*grouped):
         row = []
@@ -216,6 +213,146 @@ def all_orderings(condition_layout, block_layout):
             row.extend(block)
         yield row
 
+def block_groups(condition_layout, block_layout):
+    """Return the items and condition group sizes of each block.
+
+    :return:
+      A list with a pair for each group of block_layout, of the
+      sorted indexes in the block and the sizes of the condition
+      groups within it, in the order all_orderings uses.
+
+    >>> block_groups([[0, 1, 4, 5], [2, 3, 6, 7]], [[0, 1, 2, 3], [4, 5, 6, 7]])
+    [([0, 1, 2, 3], [2, 2]), ([4, 5, 6, 7], [2, 2])]
+
+    """
+    res = []
+    for block in as_layout(block_layout):
+        cond_groups = intersect_layouts([ block ], condition_layout )
+        res.append((sorted(block), map(len, cond_groups)))
+    return res
+
+def multinomial(sizes):
+    """Number of ways to split sum(sizes) items into groups of the given
+    sizes, where the order within each group doesn't matter.
+
+    >>> multinomial([2, 2])
+    6
+    >>> multinomial([1, 1, 1])
+    6
+
+    """
+    res = 1
+    n = 0
+    for size in sizes:
+        n += size
+        res *= comb(n, size, exact=True)
+    return int(res)
+
+def unrank_combination(items, k, rank):
+    """Return the combination of k of the items at the given rank, in the
+    order itertools.combinations produces them.
+
+    >>> [ unrank_combination([0, 1, 2, 3], 2, r) for r in range(6) ]
+    [[0, 1], [0, 2], [0, 3], [1, 2], [1, 3], [2, 3]]
+
+    """
+    res = []
+    n = len(items)
+    for (i, item) in enumerate(items):
+        if k == 0:
+            break
+
+        # Number of combinations that start with this item
+        count = comb(n - i - 1, k - 1, exact=True)
+        if rank < count:
+            res.append(item)
+            k -= 1
+        else:
+            rank -= count
+    return res
+
+def unrank_ordering(groups, rank):
+    """Return the ordering at the given rank.
+
+    :param groups:
+      The blocks of the layouts, as returned by block_groups.
+
+    :param rank:
+      Integer in [0, N), where N is the number of orderings.
+
+    :return:
+      The ordering at position rank of all_orderings for the same
+      layouts.
+
+    >>> groups = block_groups([[0, 1], [2, 3]], [[0, 1, 2, 3]])
+    >>> [ unrank_ordering(groups, r) for r in range(6) ] # doctest: +NORMALIZE_WHITESPACE
+    [[0, 1, 2, 3], [0, 2, 1, 3], [0, 3, 1, 2],
+     [1, 2, 0, 3], [1, 3, 0, 2], [2, 3, 0, 1]]
+
+    """
+    # The rank is a mixed-radix number with a digit for each block,
+    # where the last block varies fastest.
+    blocks = []
+    for (items, sizes) in reversed(groups):
+        (rank, digit) = divmod(rank, multinomial(sizes))
+
+        # Within a block, each digit is a combination for the first
+        # group, then an ordering of the remaining items in the rest.
+        row = []
+        for (i, size) in enumerate(sizes):
+            (idx, digit) = divmod(digit, multinomial(sizes[i + 1:]))
+            chosen = unrank_combination(items, size, idx)
+            row.extend(chosen)
+            items = [ x for x in items if x not in chosen ]
+        blocks.append(row)
+
+    res = []
+    for row in reversed(blocks):
+        res.extend(row)
+    return res
+
+def random_rank(n, random_state=np.random):
+    """Return a random integer in [0, n), which may be larger than numpy's
+    integers can hold."""
+
+    if n <= np.iinfo(np.int64).max:
+        return int(random_state.randint(0, n, dtype=np.int64))
+
+    # Draw enough random bits for n, and try again if we went over.
+    bits  = len(bin(n)) - 2
+    words = (bits + 31) // 32
+    while True:
+        res = 0
+        for word in random_state.randint(0, 2 ** 32, words, dtype=np.int64):
+            res = (res << 32) | int(word)
+        res >>= words * 32 - bits
+        if res < n:
+            return res
+
+def random_ranks(N, R, random_state=np.random):
+    """Return R distinct random integers in [0, N).
+
+    Uses Robert Floyd's algorithm, so it takes R random draws no matter
+    how close R is to N. Floyd's algorithm picks a uniformly random set
+    of ranks, but tends to put the small ones first, so we shuffle them
+    before returning them. Any prefix of the result is then a random
+    subset too.
+
+    >>> sorted(random_ranks(5, 5))
+    [0, 1, 2, 3, 4]
+
+    """
+    chosen = set()
+    res = []
+    for j in range(N - R, N):
+        t = random_rank(j + 1, random_state)
+        if t in chosen:
+            t = j
+        chosen.add(t)
+        res.append(t)
+    random_state.shuffle(res)
+    return res
+
 def random_ordering(layout):
     """Return a randomized ordering of the indexes within each group of
     the given layout.
@@ -228,12 +365,13 @@ def random_ordering(layout):
         row.extend(grp)
     return row
 
-def random_orderings(condition_layout, block_layout, R):
+def random_orderings(condition_layout, block_layout, R, random_state=np.random):
     """Get an iterator over at most R random index shuffles.
 
     :param full: the :term:`layout`
     :param reduced: the reduced :term:`layout`
     :param R: the maximum number of orderings to return
+    :param random_state: numpy RandomState to draw from
 
     :return: iterator over random orderings of indexes
 
@@ -242,11 +380,6 @@ def random_orderings(condition_layout, block_layout, R):
     reduced layout will be shuffled.
     
     """
-    full = intersect_layouts(block_layout, condition_layout)
-
-    # Set of random orderings we've returned so far
-    orderings = set()
-    
     # The total number of orderings of indexes within the groups of
     # the reduced layout that result in a distinct assignment of
     # indexes into the groups defined by the full layout.
@@ -259,38 +392,184 @@ def random_orderings(condition_layout, block_layout, R):
         for arr in all_orderings(condition_layout, block_layout):
             yield arr
 
-    # Otherwise repeatedly find a random ordering, and if it's not one
-    # we've already yielded, yield it.
+    # Otherwise pick R distinct positions in the list of all
+    # orderings, and construct the ordering at each one.
     else:
-        while len(orderings) < R:
+        groups = block_groups(condition_layout, block_layout)
+        for rank in random_ranks(N, R, random_state):
+            yield unrank_ordering(groups, rank)
 
-            arr = random_ordering(block_layout)
-            key = tuple(arr)
+def random_indexes(layout, R, random_state=np.random):
+    """Generates R samplings of indexes based on the given layout.
 
-            if key not in orderings:
-                orderings.add(key)
-                yield arr
+    Each sampling draws, with replacement, as many indexes from each
+    group of the layout as there are in the group.
 
-def random_indexes(layout, R):
-    """Generates R samplings of indexes based on the given layout.
+    :param layout:
+      The :term:`layout` to sample within.
+
+    :param R:
+      Number of samplings to generate.
+
+    :param random_state:
+      The numpy RandomState to draw from. Defaults to numpy's global
+      one. Pass a seeded RandomState to get the same indexes each
+      time.
+
+    :return:
+      An (R x n) array of indexes, where n is the number of indexes in
+      the layout.
 
     >>> indexes = random_indexes([[0, 1], [2, 3]], 10)
     >>> np.shape(indexes)
     (10, 4)
 
+    >>> a = random_indexes([[0, 1], [2, 3]], 10, np.random.RandomState(0))
+    >>> b = random_indexes([[0, 1], [2, 3]], 10, np.random.RandomState(0))
+    >>> np.array_equal(a, b)
+    True
+
     """
     layout = [ np.array(grp, int) for grp in layout ]
     n = sum([ len(grp) for grp in layout ])
     res = np.zeros((R, n), int)
-    
-    for i in range(R):
-        p = 0
-        q = 0
-        for j, grp in enumerate(layout):
-            nj = len(grp)
-            q  = p + nj
-            res[i, p : q] = grp[np.random.random_integers(0, nj - 1, nj)]
-            p = q
+
+    p = 0
+    for grp in layout:
+        q = p + len(grp)
+        res[:, p : q] = grp[random_state.randint(0, len(grp), (R, len(grp)))]
+        p = q
 
     return res
 
+
+DEFAULT_BOOTSTRAP_BLOCK_SIZE = 1000
+"""Number of bootstrap samplings drawn from each seeded RandomState."""
+
+class SampleIndexSpec(object):
+    """A compact description of a list of sample indexes.
+
+    Rather than storing every permutation or bootstrap sampling, we
+    store the layouts, a seed, and the number of samplings, and
+    construct any range of them when it's needed. Slicing a spec gives
+    the same indexes every time, no matter what other ranges have been
+    constructed. The samplings come in a random order, so any range of
+    them is a random subset.
+
+    >>> spec = SampleIndexSpec('permutations', [[[0, 1], [2, 3]], [[0, 1, 2, 3]]], 0, 6)
+    >>> len(spec)
+    6
+    >>> spec[1:3]
+    array([[0, 3, 1, 2],
+           [0, 2, 1, 3]])
+
+    """
+
+    KINDS = ['permutations', 'bootstrap']
+
+    def __init__(self, kind, layouts, seed, count,
+                 block_size=DEFAULT_BOOTSTRAP_BLOCK_SIZE):
+        """Create a spec.
+
+        :param kind:
+          'permutations' for distinct orderings of the condition
+          layout within the block layout, or 'bootstrap' for
+          samplings with replacement within each group of a layout.
+
+        :param layouts:
+          [condition_layout, block_layout] for permutations, or
+          [layout] for bootstrap samplings.
+
+        :param seed:
+          Integer seed for the random numbers.
+
+        :param count:
+          Number of samplings. For permutations this is at most the
+          number of distinct orderings.
+
+        """
+        if kind not in self.KINDS:
+            raise ValueError("Kind of sample indexes must be one of " +
+                             str(self.KINDS) + ", not " + str(kind))
+        self.kind       = kind
+        self.layouts    = [ [ map(int, grp) for grp in layout ]
+                            for layout in layouts ]
+        self.seed       = int(seed)
+        self.count      = int(count)
+        self.block_size = int(block_size)
+        self._ranks     = None
+
+    @classmethod
+    def permutations(cls, condition_layout, block_layout, R, seed):
+        """Spec for at most R distinct random orderings."""
+        N = num_orderings(condition_layout, block_layout)
+        return cls('permutations', [condition_layout, block_layout],
+                   seed, min(N, R))
+
+    @classmethod
+    def bootstrap(cls, layout, R, seed):
+        """Spec for R samplings with replacement within groups of layout."""
+        return cls('bootstrap', [layout], seed, R)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("Sample index specs only support contiguous slices")
+        (start, stop, step) = key.indices(self.count)
+        stop = max(start, stop)
+
+        if self.kind == 'permutations':
+            rows = self._orderings(start, stop)
+        else:
+            rows = self._bootstrap(start, stop)
+
+        n = sum(map(len, self.layouts[0]))
+        return np.array(rows, int).reshape((stop - start, n))
+
+    def _orderings(self, start, stop):
+        (condition_layout, block_layout) = self.layouts
+        N = num_orderings(condition_layout, block_layout)
+
+        # Every range needs the same ranks, so draw them all once and
+        # keep them. That's only one integer per ordering; we only
+        # construct the orderings in the range. If we want all of the
+        # orderings we still shuffle them, rather than taking them in
+        # the order all_orderings gives, which starts with the
+        # unpermuted ordering and its near neighbors.
+        if self._ranks is None:
+            random_state = np.random.RandomState(self.seed)
+            if self.count >= N:
+                self._ranks = map(int, random_state.permutation(N))
+            else:
+                self._ranks = random_ranks(N, self.count, random_state)
+        groups = block_groups(condition_layout, block_layout)
+        return [ unrank_ordering(groups, r) for r in self._ranks[start : stop] ]
+
+    def _bootstrap(self, start, stop):
+        # Each block of samplings has its own RandomState, so we only
+        # draw the blocks that overlap the range.
+        rows = []
+        first = start // self.block_size
+        last  = (stop - 1) // self.block_size if stop > start else first - 1
+        for block in range(first, last + 1):
+            random_state = np.random.RandomState([self.seed, block])
+            size = min(self.block_size, self.count - block * self.block_size)
+            indexes = random_indexes(self.layouts[0], size, random_state)
+            offset = block * self.block_size
+            rows.extend(indexes[max(start - offset, 0) : stop - offset])
+        return rows
+
+    def to_json(self):
+        return json.dumps({ 'kind'       : self.kind,
+                            'layouts'    : self.layouts,
+                            'seed'       : self.seed,
+                            'count'      : self.count,
+                            'block_size' : self.block_size })
+
+    @classmethod
+    def from_json(cls, doc):
+        doc = json.loads(doc)
+        return cls(doc['kind'], doc['layouts'], doc['seed'], doc['count'],
+                   doc['block_size'])
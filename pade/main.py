@@ -29,6 +29,11 @@ import celery
 import pade.tasks
 import textwrap
 import time
+import tempfile
+import shutil
+import gzip
+import zipfile
+import contextlib
 import pade.config
 import webbrowser
 import urllib2
@@ -37,7 +42,8 @@ import pade.analysis as an
 from collections import namedtuple
 from numpy.lib.recfunctions import append_fields
 from pade.model import Job, Model, Settings, Input, Results, Schema
-from pade.stat import GroupSymbols, stat_names, glm_families
+from pade.stat import (
+    GroupSymbols, stat_names, glm_families, DEFAULT_MAX_BATCH_BYTES)
 from pade.metadb import JobMeta
 from threading import Thread
 
@@ -160,6 +166,13 @@ def do_run(args):
     infile = os.path.abspath(args.infile)
     db     = os.path.abspath(args.output)
 
+    if args.chunk_features < 0:
+        raise UsageException("--chunk-features can't be negative.")
+    if args.compression is not None and args.chunk_features == 0:
+        raise UsageException(
+            "Only chunked datasets can be compressed, so please don't " +
+            "use --compression with --chunk-features 0.")
+
     schema = load_schema(args.schema)
     settings = args_to_settings(args)
 
@@ -171,7 +184,12 @@ def do_run(args):
         settings=settings,
         sample_indexes_path=args.sample_indexes,
         path=db,
-        job_id=0)
+        job_id=0,
+        num_shards=args.num_shards,
+        distrib=args.distrib,
+        input_cache_dir=args.input_cache,
+        compression=args.compression,
+        chunk_features=args.chunk_features)
 
     if args.distrib:
         celery.chain(steps)().get()
@@ -210,7 +228,7 @@ def do_server(args):
     app = pade.http.server.PadeRunner(config)
     if args.debug:
         app.debug = True
-    app.run(port=args.port)
+    app.run(port=args.port, threaded=True)
 
 def do_view(args):
 
@@ -224,6 +242,7 @@ def do_view(args):
         job_dbs.append(
             JobMeta(i, path, path, imported=True))
     pade.http.jobdetails.job_dbs = job_dbs
+    pade.http.jobdetails.plot_cache_dir = tempfile.mkdtemp(prefix='pade_plots_')
 
     def open_browser():
         url = "http://localhost:5000"
@@ -243,17 +262,22 @@ def do_view(args):
     t = Thread(target=open_browser)
         
     t.start()
-    app.run(port=args.port)
+    try:
+        app.run(port=args.port, threaded=True)
+    finally:
+        shutil.rmtree(pade.http.jobdetails.plot_cache_dir)
 
     
 def do_report(args):
     path = args.pade_results
 
     print("Generating report for result database {job}.".format(job=path))
-    job = pade.tasks.load_job(path)
     filename = args.output
-    save_text_output(job, filename=filename)
-    print("Saved text report to ", filename)
+    save_fn = save_npz_output if args.format == 'npz' else save_text_output
+
+    with contextlib.closing(pade.tasks.open_job(path)) as job:
+        save_fn(job, filename, compress=args.gzip)
+    print("Saved report to ", filename)
 
 
 
@@ -288,6 +312,12 @@ def args_to_settings(args):
                    "--glm-family negative_binomial.")
             raise UsageException(msg)
 
+    if args.stop_tolerance is not None and args.stop_tolerance < 0:
+        raise UsageException("--stop-tolerance can't be negative.")
+
+    if args.max_batch_mb <= 0:
+        raise UsageException("--max-batch-mb must be positive.")
+
     # Block and condition variables
     if len(args.block) > 0 or len(args.condition) > 0:
         block_variables = args.block
@@ -331,7 +361,9 @@ def args_to_settings(args):
         stat=stat,
         glm_family=args.glm_family,
         equalize_means=args.equalize_means,
-        shrink=args.shrink
+        shrink=args.shrink,
+        stop_tolerance=args.stop_tolerance,
+        max_batch_bytes=int(args.max_batch_mb * 1024 * 1024)
         )
 
 def load_schema(path):
@@ -343,73 +375,178 @@ def load_schema(path):
 
 
 
-def save_text_output(job, filename):
+DEFAULT_REPORT_CHUNK_SIZE = 10000
+"""Number of features to write to the report at a time."""
 
-    (num_rows, num_cols) = job.input.table.shape
-    num_cols += 2
-    table = np.zeros((num_rows, num_cols))
+REPORT_FORMATS = ['text', 'npz']
 
-    # Best tuning param for each feature
-    idxs = np.argmax(job.results.feature_to_score, axis=0)
-    table = []
+ReportColumn = namedtuple("ReportColumn", ['name', 'format'])
 
-    # For each row in the data, add feature id, stat, score, group
-    # means, and raw values.
-    logging.info("Building internal results table")
+def report_sources(job):
+    """Return the arrays the report is built from.
 
-    for i in range(len(job.input.table)):
-        row = []
+    If the job is open we use its datasets directly, so that only the
+    rows being written are read. Otherwise we use the arrays loaded
+    in the job.
 
-        # Feature id
-        row.append(job.input.feature_ids[i])
-        
-        # Best stat and all stats
-        row.append(job.results.raw_stats[idxs[i], i])
-        for j in range(len(job.settings.tuning_params)):
-            row.append(job.results.raw_stats[j, i])
-        
-        # Best score and all scores
-        row.append(job.results.feature_to_score[idxs[i], i])
-        for j in range(len(job.settings.tuning_params)):
-            row.append(job.results.feature_to_score[j, i])
-        row.extend(job.results.group_means.table[i])
-        row.extend(job.results.coeff_values.table[i])
-        row.extend(job.input.table[i])
-        table.append(tuple(row))
-    schema = job.schema
-
-    cols = []
-    Col = namedtuple("Col", ['name', 'dtype', 'format'])
-    def add_col(name, dtype, format):
-        cols.append(Col(name, dtype, format))
-
-    add_col(schema.feature_id_column_names[0], object, "%s")
-    add_col('best_stat', float, "%f")
-    for i, alpha in enumerate(job.settings.tuning_params):
-        add_col('stat_' + str(alpha), float, "%f")
-
-    add_col('best_score', float, "%f")
-    for i, alpha in enumerate(job.settings.tuning_params):
-        add_col('score_' + str(alpha), float, "%f")
-
-    for name in job.results.group_means.header:
-        add_col("mean: " + name, float, "%f")
-
-    for name in job.results.coeff_values.header:
-        add_col("param: " + name, float, "%f")
-
-    for i, name in enumerate(schema.sample_column_names):
-        add_col(name, float, "%f")
-        
-    dtype = [(c.name, c.dtype) for c in cols]
+    :return:
+      A dict with the input table and feature ids, the raw stats,
+      the scores, and the group means and coefficient tables, along
+      with headers for the last two.
+
+    """
+    if job.db:
+        db = job.db
+        return {
+            'feature_ids'         : db['feature_ids'],
+            'table'               : db['table'],
+            'raw_stats'           : db['raw_stats'],
+            'feature_to_score'    : db['feature_to_score'],
+            'group_means'         : db['group_means'],
+            'coeff_values'        : db['coeff_values'],
+            'group_means_header'  : db['group_means'].attrs['headers'],
+            'coeff_values_header' : db['coeff_values'].attrs['headers'] }
+    else:
+        return {
+            'feature_ids'         : job.input.feature_ids,
+            'table'               : job.input.table,
+            'raw_stats'           : job.results.raw_stats,
+            'feature_to_score'    : job.results.feature_to_score,
+            'group_means'         : job.results.group_means.table,
+            'coeff_values'        : job.results.coeff_values.table,
+            'group_means_header'  : job.results.group_means.header,
+            'coeff_values_header' : job.results.coeff_values.header }
+
+def report_columns(job, sources):
+    """List of ReportColumns for the numeric columns of the report."""
+
+    cols = [ ReportColumn('best_stat', '%f') ]
+    cols.extend(ReportColumn('stat_' + str(alpha), '%f')
+                for alpha in job.settings.tuning_params)
+
+    cols.append(ReportColumn('best_score', '%f'))
+    cols.extend(ReportColumn('score_' + str(alpha), '%f')
+                for alpha in job.settings.tuning_params)
+
+    cols.extend(ReportColumn("mean: " + name, '%f')
+                for name in sources['group_means_header'])
+    cols.extend(ReportColumn("param: " + name, '%f')
+                for name in sources['coeff_values_header'])
+    cols.extend(ReportColumn(name, '%f')
+                for name in job.schema.sample_column_names)
+    return cols
+
+def report_chunks(sources, chunk_size=DEFAULT_REPORT_CHUNK_SIZE):
+    """Yield the rows of the report in chunks.
+
+    :return:
+      An iterator over (feature_ids, values) pairs, where values is
+      a (features x columns) array laid out like report_columns.
+
+    """
+    num_features = len(sources['feature_ids'])
+
+    for start in range(0, num_features, chunk_size):
+        stop = min(start + chunk_size, num_features)
+        rows = np.arange(stop - start)
+
+        stats  = sources['raw_stats'][:, start : stop]
+        scores = sources['feature_to_score'][:, start : stop]
+
+        # Best tuning param for each feature
+        best = np.argmax(scores, axis=0)
+
+        values = np.column_stack([
+            stats[best, rows],
+            stats.T,
+            scores[best, rows],
+            scores.T,
+            sources['group_means'][start : stop],
+            sources['coeff_values'][start : stop],
+            sources['table'][start : stop]])
+
+        yield (sources['feature_ids'][start : stop], values)
+
+def save_text_output(job, filename, chunk_size=DEFAULT_REPORT_CHUNK_SIZE,
+                     compress=False):
+    """Write a tab-delimited report of the results of the job.
+
+    The report has a row for each feature with its id, statistics,
+    scores, group means, coefficients, and raw values. Rows are
+    written a chunk of features at a time.
+
+    :param compress:
+      Whether to gzip the report. Filenames ending in .gz are always
+      gzipped.
+
+    """
+    sources = report_sources(job)
+    cols = report_columns(job, sources)
+    fmt = "\t".join(["%s"] + [ c.format for c in cols ])
+
+    if compress or filename.endswith('.gz'):
+        out = gzip.open(filename, 'wb')
+    else:
+        out = open(filename, 'w')
 
     logging.info("Writing table")
-    table = np.array(table, dtype)
-    with open(filename, "w") as out:
-        out.write("\t".join(c.name for c in cols) + "\n")
-        np.savetxt(out, table, 
-                   fmt=[c.format for c in cols],
-                   delimiter="\t")
+    with contextlib.closing(out):
+        names = [ job.schema.feature_id_column_names[0] ]
+        names.extend(c.name for c in cols)
+        out.write("\t".join(names) + "\n")
+
+        for (ids, values) in report_chunks(sources, chunk_size):
+            rows = np.empty((len(ids), len(cols) + 1), object)
+            rows[:, 0]  = ids
+            rows[:, 1:] = values
+            np.savetxt(out, rows, fmt=fmt)
+
+def save_npz_output(job, filename, chunk_size=DEFAULT_REPORT_CHUNK_SIZE,
+                    compress=False):
+    """Write the report as a NumPy .npz file.
+
+    The file has 'feature_ids', 'columns' giving the name of each
+    column, and 'values', a (features x columns) array stored in
+    column-major order so each column can be read without the others.
+    Values are written a chunk of features at a time to temporary
+    .npy files, which are then added to the archive.
+
+    :param compress:
+      Whether to compress the entries of the archive.
+
+    """
+    sources = report_sources(job)
+    cols = report_columns(job, sources)
+    feature_ids = sources['feature_ids']
+    num_features = len(feature_ids)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        values = np.lib.format.open_memmap(
+            os.path.join(tmp, 'values.npy'), mode='w+', dtype=float,
+            shape=(num_features, len(cols)), fortran_order=True)
+        start = 0
+        for (ids, chunk) in report_chunks(sources, chunk_size):
+            values[start : start + len(ids)] = chunk
+            start += len(ids)
+        values.flush()
+        del values
+
+        # The ids may be variable-length strings, which numpy would
+        # store as a pickled object array; save fixed-width strings so
+        # the report loads without allow_pickle.
+        np.save(os.path.join(tmp, 'feature_ids.npy'),
+                np.asarray(feature_ids[...], dtype=str))
+        np.save(os.path.join(tmp, 'columns.npy'),
+                np.asarray([ c.name for c in cols ], dtype=str))
+
+        compression = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+        with contextlib.closing(
+            zipfile.ZipFile(filename, 'w', compression, allowZip64=True)) as out:
+            for name in ['feature_ids', 'columns', 'values']:
+                out.write(os.path.join(tmp, name + '.npy'), name + '.npy')
+    finally:
+        shutil.rmtree(tmp)
 
 
 def setup_logging(args):
@@ -646,6 +783,33 @@ def get_arguments():
         help="Distribute work",
         action='store_true')
 
+    run_parser.add_argument(
+        '--num-shards', '-j',
+        type=int,
+        default=1,
+        help="""Split the permutations into this many shards. Without --distrib, the shards run in a pool of local processes. With --distrib, each shard is a separate task.""")
+
+    run_parser.add_argument(
+        '--input-cache',
+        help="""Directory in which to cache parsed copies of input files. Later runs on the same input file can skip parsing it.""")
+
+    run_parser.add_argument(
+        '--compression',
+        choices=pade.tasks.COMPRESSION_CHOICES,
+        help="""Compress the datasets in the output file. gzip gives smaller files, lzf is faster.""")
+
+    run_parser.add_argument(
+        '--chunk-features',
+        type=int,
+        default=pade.tasks.DEFAULT_CHUNK_FEATURES,
+        help="""Number of features in each chunk of the per-feature datasets in the output file. Use 0 to store them contiguously.""")
+
+    run_parser.add_argument(
+        '--max-batch-mb',
+        type=float,
+        default=DEFAULT_MAX_BATCH_BYTES / (1024 * 1024),
+        help="""Roughly how many megabytes of samples to compute statistics for at a time. Larger batches are faster but use more memory.""")
+
     run_parser.add_argument(
         '--sample-indexes',
         help="""File specifying lists of indexes to use for sampling. See 'pade makesamples'.""")
@@ -707,6 +871,12 @@ def get_arguments():
         type=float,
         help="Interval of confidence levels")
 
+    grp.add_argument(
+        '--stop-tolerance',
+        default=pade.model.DEFAULT_STOP_TOLERANCE,
+        type=float,
+        help="Stop sampling early once the number of features at each confidence level changes by no more than this fraction between rounds of " + str(an.DEFAULT_STOP_CHECK_INTERVAL) + " samples. By default all of the samples are run.")
+
     grp.add_argument(
         '--equalize-means',
         action='store_true',
@@ -728,6 +898,18 @@ def get_arguments():
         '--output', '-o',
         required=True,
         help="""Location to write report to""")
+    report_parser.add_argument(
+        '--format',
+        choices=REPORT_FORMATS,
+        default='text',
+        help="""Write a tab-delimited text report, or a NumPy .npz
+        file with a column-major table of the values""")
+    report_parser.add_argument(
+        '--gzip',
+        action='store_true',
+        default=False,
+        help="""Compress the report. Text reports whose name ends
+        in .gz are always compressed.""")
     report_parser.add_argument(
         'pade_results', 
         help="Path to the db file to read results from")
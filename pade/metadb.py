@@ -29,6 +29,16 @@ class MetaDB(object):
         self.directory = directory
         self.redis     = redis
 
+    @property
+    def input_cache_dir(self):
+        """Directory holding parsed copies of the input files."""
+        return os.path.join(self.directory, 'input_cache')
+
+    @property
+    def plot_cache_dir(self):
+        """Directory holding rendered plots for the web views."""
+        return os.path.join(self.directory, 'plot_cache')
+
     def _next_obj_id(self, type):
         key = ":".join(('pade', 'nextid', type))
         return str(self.redis.incr(key))
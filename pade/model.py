@@ -23,7 +23,9 @@ DEFAULT_SAMPLE_FROM_RESIDUALS = False
 DEFAULT_SUMMARY_MIN_CONF = 0.1
 DEFAULT_SUMMARY_STEP_SIZE = 0.05
 DEFAULT_EQUALIZE_MEANS = False
+DEFAULT_STOP_TOLERANCE = None
 DEFAULT_TUNING_PARAMS=[0.0001, 0.001, 0.01, 0.1, 1, 3, 10, 30, 100, 300, 1000, 3000]
+DEFAULT_INPUT_CHUNK_SIZE = 100000
 
 TableWithHeader = namedtuple('TableWithHeader', ['header', 'table'])
 
@@ -172,37 +174,75 @@ class Input(object):
           with a header line.
         
         """
+        chunks = list(cls.iter_raw_file(path, schema, limit=limit))
 
-        ids = []
-        table = []
+        if len(chunks) == 0:
+            table = np.zeros((0, len(schema.sample_column_names)))
+            ids   = np.array([], str)
+        else:
+            table = np.concatenate([ c.table for c in chunks ])
+            ids   = np.concatenate([ c.feature_ids for c in chunks ])
 
-        log_interval = 100000
+        logging.debug(
+            "Input has {features} features and {samples} samples".format(
+                features=np.size(table, 0),
+                samples=np.size(table, 1)))
 
-        with open(path) as fh:
-            csvfile = csv.DictReader(fh, delimiter="\t")
-            headers = csvfile.fieldnames
+        return Input(table, ids)
 
-            sample_names = schema.sample_column_names
+    @classmethod
+    def iter_raw_file(cls, path, schema, limit=None,
+                      chunk_size=DEFAULT_INPUT_CHUNK_SIZE):
+        """Read the given input file a chunk of rows at a time.
 
-            for i, rec in enumerate(csvfile):
-                if limit is not None and i > limit:
-                    break
-                table.append([ float(rec[name]) for name in sample_names ])
-                ids.append(rec[schema.feature_id_column_names[0]])
+        Only the feature id column and the sample columns named in the
+        schema are parsed, so we never need to hold more than
+        chunk_size rows of the file in memory.
 
-                if (i % log_interval) == log_interval - 1:
-                    logging.debug("Copied {0} rows".format(i + 1))
+        :param path:
+          Path to an input file, which must be a tab-delimited file
+          with a header line.
 
-        table = np.array(table)
-        ids   = np.array(ids)
+        :param chunk_size:
+          Maximum number of rows in each chunk.
 
-        logging.debug(
-            "Input has {features} features and {samples} samples".format(
-                features=np.size(table, 0),
-                samples=np.size(table, 1)))
+        :return:
+          An iterator over Input objects, one for each chunk of rows.
 
-        return Input(table, ids)
+        """
 
+        sample_names = schema.sample_column_names
+
+        with open(path) as fh:
+            reader = csv.reader(fh, delimiter="\t")
+            headers = next(reader)
+
+            id_idx      = headers.index(schema.feature_id_column_names[0])
+            sample_idxs = [ headers.index(name) for name in sample_names ]
+
+            num_rows = 0
+            ids    = []
+            values = []
+
+            for row in reader:
+                if not row:
+                    continue
+                if limit is not None and num_rows > limit:
+                    break
+
+                ids.append(row[id_idx])
+                values.append([ row[i] for i in sample_idxs ])
+                num_rows += 1
+
+                if len(ids) == chunk_size:
+                    yield Input(np.array(values, float), np.array(ids))
+                    logging.debug("Read {0} rows".format(num_rows))
+                    ids    = []
+                    values = []
+
+            if len(ids) > 0:
+                yield Input(np.array(values, float), np.array(ids))
+                logging.debug("Read {0} rows".format(num_rows))
 
 
 class Settings:
@@ -224,7 +264,9 @@ class Settings:
         summary_step_size=DEFAULT_SUMMARY_STEP_SIZE,
         tuning_params=DEFAULT_TUNING_PARAMS,
         equalize_means_ids=None,
-        shrink=False):
+        shrink=False,
+        stop_tolerance=DEFAULT_STOP_TOLERANCE,
+        max_batch_bytes=pade.stat.DEFAULT_MAX_BATCH_BYTES):
 
         if stat is None:
             raise Exception('stat is a required option')
@@ -280,6 +322,23 @@ class Settings:
         self.equalize_means_ids = equalize_means_ids
         """List of ids of features to equalize means for."""
 
+        self.stop_tolerance = stop_tolerance
+        """If given, stop sampling early once the summary settles.
+
+        The samples are run in rounds, and we stop once the number of
+        features at each confidence level changes by no more than this
+        fraction from one round to the next. If None, always run
+        num_samples samples.
+
+        """
+
+        self.max_batch_bytes = max_batch_bytes
+        """Roughly how many bytes of samples to build at a time.
+
+        Larger batches are faster, but use more memory.
+
+        """
+
 
 class Results:
     """The bulk of the results of the job."""
@@ -291,8 +350,12 @@ class Results:
         self.bin_to_mean_perm_count = None
         self.bin_to_score = None
         self.feature_to_score = None
+        self.feature_best_score = None
+        self.feature_means = None
+        self.feature_variances = None
         self.raw_stats = None
         self.sample_indexes = None
+        self.num_samples_used = None
         self.group_means = None
         self.coeff_values = None
         self.fold_change = None
@@ -315,7 +378,8 @@ class Job:
                  schema=None,
                  settings=None,
                  results=None,
-                 summary=None):
+                 summary=None,
+                 db=None):
         
         if settings is None:
             raise Exception("settings is a required argument")
@@ -327,11 +391,20 @@ class Job:
         self.results  = results
         self.summary  = summary
 
+        self.db = db
+        """Open job db that parts of the job are lazily read from, if any."""
+
         stat = self.get_stat_fn()
         if self.settings.equalize_means and not stat.ALLOWS_EQUALIZED_MEANS:
             raise InvalidSettingsException(
                 "Can't equalize means with statistic " + str(stat))
 
+    def close(self):
+        """Close the job db, if the job was opened lazily."""
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
     def get_stat_fn(self):
         """The statistic used for this job."""
 
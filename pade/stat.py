@@ -15,13 +15,17 @@ import pade.family
 
 from collections import namedtuple
 from scipy.stats import gmean
-from bisect import bisect
 from itertools import repeat
 from pade.layout import (
-    intersect_layouts, apply_layout, layout_is_paired)
+    intersect_layouts, apply_layout, layout_is_paired, random_indexes)
 
 import pade.glm as glm
 
+# Budget for a batch of samples in bootstrap. A typical RNA-seq table
+# of 50,000 features and 12 samples takes about 5 MB per sample, so
+# this fits about fifty samples in a batch.
+DEFAULT_MAX_BATCH_BYTES = 256 * 1024 * 1024
+
 class UnknownStatisticException(Exception):
     pass
 
@@ -35,6 +39,16 @@ def double_sum(data):
     return np.sum(np.sum(data, axis=-1), axis=-1)
 
 
+def sum_of_squares(data):
+    """Returns the sum of the squares of data over the last axis.
+
+    >>> sum_of_squares(np.array([[1., 2.], [3., 4.]]))
+    array([  5.,  25.])
+
+    """
+    return np.einsum('...i,...i->...', data, data)
+
+
 def group_means(data, layout):
     """Get the means for each group defined by layout.
 
@@ -202,6 +216,72 @@ def categories(cond_layout, block_layout):
     
     return res
 
+def indicator_matrix(layout, num_samples=None):
+    """Returns an (N x G) matrix indicating which group each sample is in.
+
+    Element (i, j) is 1 if index i is in group j of the layout, and 0
+    otherwise. Multiplying an (M x N) table by this matrix gives the
+    sum of each group for each row.
+
+    >>> indicator_matrix([[0, 2], [1, 3]]) # doctest: +NORMALIZE_WHITESPACE
+    array([[ 1.,  0.],
+           [ 0.,  1.],
+           [ 1.,  0.],
+           [ 0.,  1.]])
+
+    :param layout:
+      A :term:`layout`.
+
+    :param num_samples:
+      Optional number of rows for the matrix. Defaults to the total
+      number of indexes in the layout.
+
+    """
+    if num_samples is None:
+        num_samples = sum(map(len, layout))
+
+    res = np.zeros((num_samples, len(layout)))
+    for j, grp in enumerate(layout):
+        res[list(grp), j] = 1
+    return res
+
+def group_counts(idxs, layout, num_columns):
+    """Count how many times each column is sampled into each group.
+
+    :param idxs:
+      A (P x N) array of indexes, where each row is one sampling of
+      the columns of some data.
+
+    :param layout:
+      A layout grouping the N positions of each sampling.
+
+    :param num_columns:
+      The number of columns in the data being sampled.
+
+    :return:
+      A (num_columns x P x G) array, where element (i, p, g) is the
+      number of positions in group g of the layout that row p of
+      idxs fills with column i. Its tensor product with the last axis
+      of the data gives the sum of each group in each sampling.
+
+    >>> counts = group_counts([[0, 1, 2, 3], [1, 1, 0, 2]], [[0, 1], [2, 3]], 4)
+    >>> np.tensordot([1., 10., 100., 1000.], counts, axes=(-1, 0))
+    array([[   11.,  1100.],
+           [   20.,   101.]])
+
+    """
+    idxs = np.asarray(idxs)
+    (P, N) = np.shape(idxs)
+    G = len(layout)
+
+    group_of = np.zeros(N, int)
+    for (g, grp) in enumerate(layout):
+        group_of[list(grp)] = g
+
+    cells = (idxs * P + np.arange(P)[:, np.newaxis]) * G + group_of
+    counts = np.bincount(np.ravel(cells), minlength=num_columns * P * G)
+    return counts.reshape((num_columns, P, G)).astype(float)
+
 def contrast(cond_layout, block_layout):
 
     """Returns the contrast matrix for the given layout pair.
@@ -405,6 +485,8 @@ class FStat(LayoutPairTest):
 
     ALLOWS_EQUALIZED_MEANS = True
 
+    ALLOWS_BATCHES = True
+
     NAME = "f"
 
     def validate_layouts(cls, condition_layout, block_layout):
@@ -423,20 +505,136 @@ class FStat(LayoutPairTest):
         self.layout_full = intersect_layouts(block_layout, condition_layout)
         self.alphas = alphas
 
+        # Multiplying the data by one of these matrices gives the sum
+        # of each group divided by the square root of its size. The
+        # sum of the squares of those values is the part of the sum
+        # of squares explained by the group means, so we can get the
+        # residual sum of squares for either model from a single
+        # matrix product.
+        n = sum(map(len, self.block_layout))
+        self._full_weights = self._weights(self.layout_full, n)
+        self._red_weights  = self._weights(self.block_layout, n)
+
+        # For computing the statistic from group sums: the size of
+        # each group, and which block each group of the full layout
+        # falls in.
+        self._full_sizes = np.array(map(len, self.layout_full), float)
+        self._red_sizes  = np.array(map(len, self.block_layout), float)
+        self._full_to_red = np.array(
+            [ [ set(grp) <= set(block) for block in self.block_layout ]
+              for grp in self.layout_full ], float)
+
+    @staticmethod
+    def _weights(layout, n):
+        sizes = np.array(map(len, layout), float)
+        return indicator_matrix(layout, n) / np.sqrt(sizes)
+
     def __call__(self, data):
 
+        n = sum(map(len, self.block_layout))
+
+        # Subtracting the mean of each row doesn't change the residual
+        # sums of squares, but keeps the subtraction below from losing
+        # precision when the values are large.
+        data = np.asarray(data, float)
+        data = data - np.dot(data, np.ones(n) / n)[..., np.newaxis]
+
+        return self._from_sums_of_squares(
+            sum_of_squares(data),
+            sum_of_squares(np.dot(data, self._full_weights)),
+            sum_of_squares(np.dot(data, self._red_weights)))
+
+    def permuted(self, data, idxs):
+        """Compute the statistic for a batch of samplings of data.
+
+        Gives the same result as calling the statistic on
+        data[..., idxs] with the sampling axis moved just in front of
+        the feature axes, without building the samples. So for an
+        (M x N) table and P samplings the result is (P x M), or
+        (T x P x M) with T tuning params.
+
+        >>> ftest = FStat([[0, 1], [2, 3]], [[0, 1, 2, 3]])
+        >>> data = np.array([[1., 2., 3., 6.], [2., 1., 1., 1.]])
+        >>> ftest.permuted(data, [[0, 1, 2, 3], [0, 2, 1, 3]])
+        array([[ 3.6,  1. ],
+               [ 0.8,  1. ]])
+
+        """
+        res = list(self.permuted_by_param(data, idxs))
+        return res[0] if self.alphas is None else np.array(res)
+
+    def permuted_by_param(self, data, idxs):
+        """Like :meth:`permuted`, but yields the (P x M) result for one
+        tuning param at a time.
+
+        The sums of squares only need the sum of each group in each
+        sampling, which we get for the whole batch from one matrix
+        product. Only the division by the denominator shifted by each
+        tuning param is done separately, so a caller that uses each
+        result and drops it never holds them all.
+
+        """
+        data = np.asarray(data, float)
+        data = data - np.mean(data, axis=-1)[..., np.newaxis]
+
+        # Put the sampling axis first in each product, so that every
+        # array below is laid out in the order we return it.
+        counts = group_counts(idxs, self.layout_full, np.shape(data)[-1])
+        full_sums = np.tensordot(counts, data, axes=(0, -1))
+        red_sums  = np.tensordot(self._full_to_red, full_sums, axes=(0, 1))
+
+        (numer, denom) = self._numer_and_denom(
+            np.tensordot(np.sum(counts, axis=-1), data ** 2, axes=(0, -1)),
+            np.tensordot(1.0 / self._full_sizes, full_sums ** 2, axes=(0, 1)),
+            np.tensordot(1.0 / self._red_sizes,  red_sums ** 2,  axes=(0, 0)))
+        del full_sums, red_sums
+
+        if self.alphas is None:
+            yield numer / denom
+        else:
+            for alpha in self.alphas:
+                yield numer / (denom + alpha)
+
+    def permuted_width(self):
+        """Number of floats per feature we hold for each sampling when
+        computing the statistic for a batch, one tuning param at a
+        time, and counting it into a histogram.
+
+        Counts the group sums and their squares for both models, the
+        sums of squares and the numerator and denominator derived from
+        them, the result for one tuning param and the shifted
+        denominator it's computed from, and the bin indexes the
+        histogram needs for it.
+
+        """
+        G = len(self.layout_full)
+        B = len(self.block_layout)
+        return 2 * G + 2 * B + 11
+
+    def _numer_and_denom(self, total, explained_full, explained_red):
+        """Compute the numerator and denominator of the statistic from the
+        total sum of squares and the parts explained by the full and
+        reduced models."""
+
         # Degrees of freedom
         p_red  = len(self.block_layout)
         p_full = len(self.layout_full)
         n      = sum(map(len, self.block_layout))
 
-        # Means and residual sum of squares for the reduced and full
-        # model
-        rss_full = rss(data, self.layout_full)
-        rss_red  = rss(data, self.block_layout)
+        # Residual sum of squares for the reduced and full model
+        rss_full = total - explained_full
+        rss_red  = total - explained_red
+        rss_full = np.maximum(rss_full, 0.0)
 
         numer = (rss_red - rss_full) / (p_full - p_red)
         denom = rss_full / (n - p_full)
+        return (numer, denom)
+
+    def _from_sums_of_squares(self, total, explained_full, explained_red):
+        """Compute the statistic from the total sum of squares and the parts
+        explained by the full and reduced models."""
+
+        (numer, denom) = self._numer_and_denom(total, explained_full, explained_red)
 
         if self.alphas is not None:
             denom = np.array([denom + x for x in self.alphas])
@@ -447,6 +645,8 @@ class OneSampleTTest:
 
     ALLOWS_EQUALIZED_MEANS = False
 
+    ALLOWS_BATCHES = True
+
     def __init__(self, alphas=None):
         self.alphas = alphas
 
@@ -492,6 +692,8 @@ class MeansRatio(LayoutPairTest):
 
     ALLOWS_EQUALIZED_MEANS = False
 
+    ALLOWS_BATCHES = True
+
     NAME = "means_ratio"
 
     def validate_layouts(cls, condition_layout, block_layout):
@@ -514,37 +716,97 @@ class MeansRatio(LayoutPairTest):
         self.alphas    = alphas
         self.symmetric = symmetric
 
-
-    def __call__(self, data):
-
+        # Build two new layouts. c0 is a list of lists of indexes into
+        # the data that represent condition 0 for each block. c1 is
+        # the same for data that represent condition 1 for each block.
         conds  = self.condition_layout
         blocks = self.block_layout
+        self._c0_blocks = intersect_layouts(blocks, [ conds[0] ])
+        self._c1_blocks = intersect_layouts(blocks, [ conds[1] ])
 
 
-        # Build two new layouts. c0 is a list of lists of indexes into
-        # the data that represent condition 0 for each block. c1 is
-        # the same for data that represent condition 1 for each block.
-        c0_blocks = intersect_layouts(blocks, [ conds[0] ])
-        c1_blocks = intersect_layouts(blocks, [ conds[1] ])
+    def __call__(self, data):
 
         # Get the mean for each block for both conditions.
-        means0 = group_means(data, c0_blocks)
-        means1 = group_means(data, c1_blocks)
+        means0 = group_means(data, self._c0_blocks)
+        means1 = group_means(data, self._c1_blocks)
+        return self._from_means(means0, means1)
+
+    def permuted(self, data, idxs):
+        """Compute the statistic for a batch of samplings of data.
+
+        Gives the same result as calling the statistic on
+        data[..., idxs] with the sampling axis moved just in front of
+        the feature axes: (P x M) for an (M x N) table and P
+        samplings, or (T x P x M) with T tuning params.
+
+        >>> ratio = MeansRatio([[0, 1], [2, 3]], [[0, 1, 2, 3]])
+        >>> data = np.array([[1., 3., 2., 6.], [2., 2., 1., 1.]])
+        >>> ratio.permuted(data, [[0, 1, 2, 3], [2, 3, 0, 1]])
+        array([[ 2.,  2.],
+               [ 2.,  2.]])
+
+        """
+        res = list(self.permuted_by_param(data, idxs))
+        return res[0] if self.alphas is None else np.array(res)
+
+    def permuted_by_param(self, data, idxs):
+        """Like :meth:`permuted`, but yields the (P x M) result for one
+        tuning param at a time.
+
+        The means of each block for both conditions come from one
+        matrix product for the whole batch. Only the ratios of the
+        means shifted by each tuning param are computed separately.
+
+        """
+        layout = self._c0_blocks + self._c1_blocks
+        sizes  = np.array(map(len, layout), float)
+        counts = group_counts(idxs, layout, np.shape(data)[-1])
+
+        # Put the sampling axis first and the blocks last, the order
+        # _ratio needs and the order we return the results in.
+        means = np.tensordot(counts, data, axes=(0, -1))
+        means = np.ascontiguousarray(np.rollaxis(means, 1, np.ndim(means)))
+        means /= sizes
+
+        k = len(self._c0_blocks)
+        (means0, means1) = (means[..., :k], means[..., k:])
+        if self.alphas is None:
+            yield self._ratio(means0, means1)
+        else:
+            for alpha in self.alphas:
+                yield self._ratio(means0 + alpha, means1 + alpha)
+
+    def permuted_width(self):
+        """Number of floats per feature we hold for each sampling when
+        computing the statistic for a batch, one tuning param at a
+        time, and counting it into a histogram.
+
+        Counts the means of each block for both conditions, the
+        shifted means, ratios and logs of the ratios for one tuning
+        param, and their geometric mean, its inverse, the larger of
+        the two, and the bin indexes the histogram needs for it.
+
+        """
+        K = len(self._c0_blocks) + len(self._c1_blocks)
+        return 4 * K + 5
+
+    def _from_means(self, means0, means1):
+        """Compute the ratio from the means of each block for condition 0
+        and condition 1."""
 
         # If we have tuning params, add another dimension to the front
-        # of each ndarray to vary the tuning param.
+        # to vary the tuning param.
         if self.alphas is not None:
-            shape = (len(self.alphas),) + np.shape(means0)
-            old0 = means0
-            old1 = means1
-            means0 = np.zeros(shape)
-            means1 = np.zeros(shape)
-            for i, a in enumerate(self.alphas):
-                means0[i] = old0 + a
-                means1[i] = old1 + a
-
-        means0 /= means1
-        ratio = means0
+            return np.array([ self._ratio(means0 + a, means1 + a)
+                              for a in self.alphas ])
+        return self._ratio(means0, means1)
+
+    def _ratio(self, means0, means1):
+        """Compute the ratio from the means of each block for condition 0
+        and condition 1, after shifting them by any tuning param."""
+
+        ratio = means0 / means1
 
         # If we have more than one block, we combine their ratios
         # using the geometric mean.
@@ -554,10 +816,7 @@ class MeansRatio(LayoutPairTest):
         # matter, so we should always return a ratio >= 1. So for any
         # ratios that are < 1, use the inverse.
         if self.symmetric:
-            # Add another dimension to the front where and 1 is its
-            # inverse, then select the max across that dimension
-            ratio_and_inverse = np.array([ratio, 1.0 / ratio])
-            ratio = np.max(ratio_and_inverse, axis=0)
+            ratio = np.maximum(ratio, 1.0 / ratio)
 
         return ratio
         
@@ -599,6 +858,8 @@ class OneSampleDifferenceTStat(LayoutPairTest):
 
     ALLOWS_EQUALIZED_MEANS = False
 
+    ALLOWS_BATCHES = True
+
     def __init__(self, condition_layout, block_layout, alphas=None):
         super(OneSampleDifferenceTStat, self).__init__(condition_layout, block_layout)
 
@@ -696,7 +957,8 @@ def bootstrap(data,
               layout=None,
               permutations=None,
               residuals=None,
-              bins=None):
+              bins=None,
+              max_batch_bytes=DEFAULT_MAX_BATCH_BYTES):
     """Run bootstrapping.
 
     This function should most likely accept data of varying
@@ -742,6 +1004,14 @@ def bootstrap(data,
       An optional list of numbers representing the edges of bins into
       which we will accumulate mean counts of statistics.
 
+    :param max_batch_bytes:
+      If *stat_fn* has a true ALLOWS_BATCHES attribute, it accepts a
+      (P x M x N) block of samples and returns statistics for all P
+      of them at once. In that case we build as many samples at a
+      time as will fit in roughly this many bytes. Statistics that
+      don't allow batches are always called with one sample at a
+      time.
+
     :return:
       If *bins* is not provided, I will return an :math:`(R x M)`
       array giving the value of the statistic for each row of *data*
@@ -754,44 +1024,214 @@ def bootstrap(data,
 
       """
 
-    if residuals is None:
-        build_sample = lambda idxs: data[..., idxs]
-    else:
-        build_sample = lambda idxs: data + residuals[..., idxs]
-
     if permutations is None:
         if layout is None:
             layout = [ np.arange(np.shape(data)[1]) ]
         permutations = random_indexes(layout, R)
 
+    permutations = np.asarray(permutations)
+
+    # Build a (P x M x N) block of samples from a (P x N) block of
+    # indexes. Indexing the last axis of data with a 2d array puts
+    # the sample axis just before the last one, so move it to the
+    # front.
+    if residuals is None:
+        build_samples = lambda idxs: np.rollaxis(data[..., idxs], -2)
+    else:
+        build_samples = lambda idxs: data + np.rollaxis(residuals[..., idxs], -2)
+
+    permuted = residuals is None and hasattr(stat_fn, 'permuted')
+
+    if permuted:
+
+        # Each sampling only costs a few arrays with one value per
+        # feature, rather than a full copy of the data.
+        size = batch_size(data, max_batch_bytes, stat_fn.permuted_width())
+
+        # The statistic can work from the group sums of each sample,
+        # so we never need to build the samples.
+        def stats_for(idxs):
+            res = stat_fn.permuted(data, idxs)
+            return np.rollaxis(res, np.ndim(res) - np.ndim(data))
+
+    elif getattr(stat_fn, 'ALLOWS_BATCHES', False):
+        size = batch_size(data, max_batch_bytes)
+
+        # The statistic puts the sample axis just in front of the
+        # axes that came from data, after any axes it adds itself
+        # (like the one for tuning params). Move it to the front.
+        def stats_for(idxs):
+            res = stat_fn(build_samples(idxs))
+            return np.rollaxis(res, np.ndim(res) - np.ndim(data))
+
+    else:
+        size = 1
+        stats_for = lambda idxs: np.array([ stat_fn(s) for s in build_samples(idxs) ])
+
+    logging.debug("Bootstrapping {R} samples, {size} at a time".format(
+            R=len(permutations), size=size))
+
+    batches = (permutations[i : i + size]
+               for i in range(0, len(permutations), size))
+
     # If we did not get bins, we simply return an ndarray of all the
-    # statistics we got. So initialize the result to [], reduce it by
-    # just appending the new result to the table, and finalize it by
-    # turning it into an ndarray.
+    # statistics we got. Each batch gives a (P x ...) array of
+    # statistics for P samples.
     if bins is None:
-        initial_value = []
-        reduce_fn = lambda res, val: res + [ val ],
-        finalize_fn = lambda x: np.array(x)
+        return np.concatenate([ stats_for(idxs) for idxs in batches ])
 
     # If we got bins, we want to accumulate counts into those bins and
     # then take the average by dividing the count in each bins by the
-    # number of permutations.
+    # number of permutations. The counts for a batch are the same as
+    # the counts for all of its statistics lumped together along the
+    # last axis, so we only need one histogram per batch.
+    res = np.zeros(cumulative_hist_shape(bins))
+
+    if permuted:
+        # Count the statistics for one tuning param at a time, so we
+        # never hold them for all the tuning params at once.
+        num_edges = np.shape(bins)[-1]
+        rows = zip(res.reshape((-1, num_edges - 1)),
+                   np.reshape(bins, (-1, num_edges)))
+        for idxs in batches:
+            by_param = stat_fn.permuted_by_param(data, idxs)
+            for ((counts, row_bins), stats) in zip(rows, by_param):
+                add_cumulative_hist(counts, stats, row_bins)
+
     else:
-        initial_value = np.zeros(cumulative_hist_shape(bins))
-        reduce_fn = lambda res, val : res + cumulative_hist(val, bins)
-        finalize_fn = lambda res : res / len(permutations)
+        for idxs in batches:
+            batch = stats_for(idxs)
+            lumped = np.rollaxis(batch, 0, np.ndim(batch) - 1)
+            lumped = lumped.reshape(np.shape(lumped)[:-2] + (-1,))
+            add_cumulative_hist(res, lumped, bins)
 
-    # We'll return an R x n array, where n is the number of
-    # features. Each row is the array of statistics for all the
-    # features, using a different random sampling.
-    
-    samples = (build_sample(p) for p in permutations)
-    stats   = (stat_fn(s)      for s in samples)
+    return res / len(permutations)
 
-    reduced = reduce(reduce_fn, stats, initial_value)
-    res = finalize_fn(reduced)
 
-    return res
+def batch_size(data, max_batch_bytes, width=None):
+    """Returns the number of samples of data that fit in max_batch_bytes.
+
+    >>> batch_size(np.zeros((100, 8)), 64000)
+    10
+
+    If each sample takes width floats for each feature (row) of data,
+    rather than a full copy of data, give width.
+
+    >>> batch_size(np.zeros((100, 8)), 64000, width=2)
+    40
+
+    Always returns at least one, no matter how small the budget is.
+
+    >>> batch_size(np.zeros((100, 8)), 1)
+    1
+
+    """
+    if width is None:
+        width = np.shape(data)[-1]
+    num_features = np.size(data) // np.shape(data)[-1]
+    sample_bytes = num_features * width * np.dtype(float).itemsize
+    return max(1, int(max_batch_bytes // sample_bytes))
+
+def chunked_percentile(table, per, chunk_size, num_bins=1000,
+                       max_passes=100):
+    """Score at a percentile of all the values in table, reading it in chunks.
+
+    Gives the same result as scipy.stats.scoreatpercentile on all the
+    values in table, but only reads chunk_size rows at a time, so
+    table can be an HDF5 dataset too big to load. We find each value
+    we need by narrowing down a range of values that contains it:
+    each pass over the table counts the values in the range with a
+    histogram, and the bin holding the value we want becomes the next
+    range. Once few enough values are left in the range, or they are
+    all equal, we read them and sort them.
+
+    NaNs sort after every other value, as they do for
+    scoreatpercentile, so a percentile that falls among them is NaN.
+
+    :param table:
+      An array or dataset of values.
+
+    :param per:
+      The percentile, between 0 and 100.
+
+    :param chunk_size:
+      Number of rows to read at a time. We never hold more than about
+      two chunks' worth of values, unless max_passes is reached.
+
+    :param num_bins:
+      Number of bins to divide the range into on each pass.
+
+    :param max_passes:
+      Most passes to make narrowing the range for one value. If the
+      range still holds too many values after this many, we read them
+      all at once.
+
+    >>> table = np.random.RandomState(0).gamma(0.5, 100, (1000, 6))
+    >>> chunked_percentile(table, 1.0, 10, 4) == np.percentile(table, 1.0)
+    True
+
+    """
+    num_rows = len(table)
+    n = np.size(table)
+    max_values = max(1, chunk_size * (n // max(num_rows, 1)))
+
+    def chunks(lo, hi):
+        for start in range(0, num_rows, chunk_size):
+            values = np.ravel(table[start : start + chunk_size])
+            yield values[(values >= lo) & (values <= hi)]
+
+    def count_range(lo, hi):
+        """Number, min, and max of the values between lo and hi."""
+        (count, vmin, vmax) = (0, np.inf, -np.inf)
+        for v in chunks(lo, hi):
+            if len(v):
+                count += len(v)
+                vmin = min(vmin, np.min(v))
+                vmax = max(vmax, np.max(v))
+        return (count, vmin, vmax)
+
+    # The comparisons in chunks() drop NaNs, so whatever isn't counted
+    # over the whole range is NaN.
+    (num_finite, lo, hi) = count_range(-np.inf, np.inf)
+
+    def value_at_rank(rank, lo, hi):
+        if rank >= num_finite:
+            return np.nan
+
+        # Number of values below lo
+        below = 0
+
+        for passes in range(max_passes):
+            (count, lo, hi) = count_range(lo, hi)
+            if lo == hi:
+                return lo
+            if count <= max_values:
+                break
+
+            # If floats can't divide the range any finer, every value
+            # in it is lo or hi.
+            edges = np.unique(np.linspace(lo, hi, num_bins + 1))
+            if len(edges) < 3:
+                num_lo = sum(np.sum(v == lo) for v in chunks(lo, hi))
+                return lo if rank - below < num_lo else hi
+
+            counts = sum(np.histogram(v, edges)[0] for v in chunks(lo, hi))
+            cum = np.cumsum(counts)
+            i = np.searchsorted(cum, rank - below, side='right')
+            below += cum[i - 1] if i > 0 else 0
+            (lo, hi) = (edges[i], edges[i + 1])
+
+        values = np.sort(np.concatenate(list(chunks(lo, hi))))
+        return values[rank - below]
+
+    # Interpolate between the two closest ranks the way scipy does
+    idx = per / 100.0 * (n - 1)
+    i = int(idx)
+    if i == idx:
+        return value_at_rank(i, lo, hi)
+    values  = np.array([ value_at_rank(i, lo, hi), value_at_rank(i + 1, lo, hi) ])
+    weights = np.array([ i + 1 - idx, idx - i ])
+    return np.add.reduce(values * weights) / weights.sum()
 
 def cumulative_hist_shape(bins):
     """Returns the shape of the histogram with the given bins.
@@ -812,13 +1252,55 @@ def cumulative_hist(values, bins):
     listing of values. The last dimension of bins is the list of bin
     edges for the histogram.
 
+    >>> cumulative_hist([[1, 2, 2, 3], [0, 1, 5, 9]], [[0, 2, 4], [0, 5, 10]])
+    array([[ 4.,  3.],
+           [ 4.,  2.]])
+
     """
-    shape = cumulative_hist_shape(bins) 
-    res = np.zeros(shape)
-    for idx in np.ndindex(shape[:-1]): 
-        (hist, ignore) = np.histogram(values[idx], bins[idx]) 
-        res[idx] = np.array(np.cumsum(hist[::-1])[::-1], float)
-    return res
+    return add_cumulative_hist(
+        np.zeros(cumulative_hist_shape(bins)), values, bins)
+
+
+def add_cumulative_hist(counts, values, bins):
+    """Add the cumulative histogram of values into counts, in place.
+
+    Values and bins are as for :func:`cumulative_hist`, and counts
+    must have the shape given by :func:`cumulative_hist_shape` for
+    bins. Like np.histogram, every bin but the last is half-open, and
+    the last one includes its right edge. Values that fall outside of
+    the bins are not counted.
+
+    Returns counts.
+
+    >>> counts = np.zeros(2)
+    >>> add_cumulative_hist(counts, [1, 2, 2, 3], [0, 2, 4])
+    array([ 4.,  3.])
+    >>> add_cumulative_hist(counts, [4, 5], [0, 2, 4])
+    array([ 5.,  4.])
+
+    """
+    values = np.asarray(values)
+    bins   = np.asarray(bins)
+    num_edges = np.shape(bins)[-1]
+
+    num_rows = np.size(bins) // num_edges
+    vals = values.reshape((num_rows, -1))
+    last = bins.reshape((num_rows, num_edges))[:, -1:]
+
+    # Find the bin each value falls into, numbering the bins from 1
+    # so that 0 is below the first edge and num_edges is above the
+    # last one. Give each row its own range of bin numbers so we can
+    # count all the rows with one call to bincount.
+    idxs = searchsorted_rows(bins, values, side='right').reshape(np.shape(vals))
+    idxs[vals == last] = num_edges - 1
+    idxs += (num_edges + 1) * np.arange(num_rows)[:, np.newaxis]
+
+    hist = np.bincount(idxs.ravel(), minlength=num_rows * (num_edges + 1))
+    hist = hist.reshape((num_rows, num_edges + 1))[:, 1 : num_edges]
+    cumulative = np.cumsum(hist[:, ::-1], axis=1)[:, ::-1]
+
+    counts += cumulative.reshape(np.shape(counts))
+    return counts
 
 
 def bins_uniform(num_bins, stats):
@@ -889,6 +1371,78 @@ def confidence_scores(raw_counts, perm_counts, num_features):
     return res
 
 
+def searchsorted_rows(bins, values, side='left'):
+    """Like np.searchsorted, but for each row of bins and values.
+
+    The shapes of bins and values must be the same except for the
+    last dimension. For each index i into all but the last dimension,
+    finds the indexes into the sorted list bins[i] at which values[i]
+    would be inserted.
+
+    >>> searchsorted_rows([[0, 2, 4], [0, 5, 10]], [[1, 2], [5, 11]], side='right')
+    array([[1, 2],
+           [2, 3]])
+
+    """
+    bins   = np.asarray(bins)
+    values = np.asarray(values)
+
+    rows = bins.reshape((-1, np.shape(bins)[-1]))
+    vals = values.reshape((len(rows), -1))
+    res  = np.empty(np.shape(vals), int)
+
+    for i, (row, row_vals) in enumerate(zip(rows, vals)):
+        res[i] = np.searchsorted(row, row_vals, side=side)
+
+    return res.reshape(np.shape(values))
+
+
+class ScoreLookup(object):
+    """Maps statistic values to the bins they fall in and the
+    confidence scores for those bins.
+
+    :param bins: 
+      An array of bin edges, with a row of monotonically increasing
+      edges for each tuning param.
+
+    :param scores:
+      An array the same shape as bins except that the last dimension
+      has one less element, where scores[..., i] is the confidence
+      level associated with statistics that fall in the range
+      [bins[..., i], bins[..., i + 1]).
+
+    >>> lookup = ScoreLookup([[0, 2, 4], [0, 5, 10]], [[0.1, 0.2], [0.3, 0.4]])
+    >>> lookup.bin_indexes([[1, 2], [5, 9]])
+    array([[0, 1],
+           [1, 1]])
+    >>> lookup([[1, 2], [5, 9]])
+    array([[ 0.1,  0.2],
+           [ 0.4,  0.4]])
+
+    """
+
+    def __init__(self, bins, scores):
+        self.bins = np.asarray(bins)
+        self.scores = np.asarray(scores)
+
+    def bin_indexes(self, stats):
+        """Returns the index of the bin each statistic falls in.
+
+        Stats must have the same shape as bins except for the last
+        dimension, which lists the statistics for one tuning param.
+
+        """
+        return searchsorted_rows(self.bins, stats, side='right') - 1
+
+    def __call__(self, stats):
+        """Returns the confidence score for each statistic."""
+        idxs = self.bin_indexes(stats)
+        scores = self.scores.reshape((-1, np.shape(self.scores)[-1]))
+        rows = np.arange(len(scores))[:, np.newaxis]
+        res = scores[rows, idxs.reshape((len(scores), -1))]
+        return res.reshape(np.shape(idxs))
+
+
 def assign_scores_to_features(stats, bins, scores):
     """Return an array that gives the confidence score for each feature.
     
@@ -913,14 +1467,7 @@ def assign_scores_to_features(stats, bins, scores):
                                                 num_bins=np.shape(bins),
                                                 num_scores=np.shape(scores)))
 
-    shape = np.shape(stats)
-    res = np.zeros(shape)
-
-    for idx in np.ndindex(shape):
-        prefix = idx[:-1]
-        stat = stats[idx]
-        scores_idx = prefix + (bisect(bins[prefix], stat) - 1,)
-        res[idx] = scores[scores_idx]
+    res = ScoreLookup(bins, scores)(stats)
     logging.debug("Scores have shape {0}".format(np.shape(res)))
     return res
 
@@ -14,40 +14,207 @@ import pade.analysis as an
 import numpy as np
 import h5py
 import contextlib
+import multiprocessing
 import time
 import os
+import errno
+import hashlib
+import json
 
 from StringIO import StringIO
+from celery import chord
 from pade.celery import celery
 from pade.stat import (
     cumulative_hist, bins_uniform, confidence_scores, 
-    assign_scores_to_features)
+    assign_scores_to_features, DEFAULT_MAX_BATCH_BYTES)
 from pade.model import (
     Job, Settings, Results, Input, TableWithHeader, Summary, Schema)
+from pade.layout import SampleIndexSpec
+
+DEFAULT_CHUNK_SIZE = 10000
+"""Number of features to compute raw statistics for at a time."""
+
+DEFAULT_CHUNK_FEATURES = 4096
+"""Number of features in each HDF5 chunk of the per-feature datasets."""
+
+COMPRESSION_CHOICES = ['gzip', 'lzf']
 
 def save_table(db, table, name):
-    db.create_dataset(name, data=table.table)
+    create_dataset(db, name, data=table.table)
     db[name].attrs['headers'] = table.header        
 
+def create_table(db, name, header, shape):
+    create_dataset(db, name, shape, float)
+    db[name].attrs['headers'] = header
+
+def set_storage(db, compression=None, chunk_features=DEFAULT_CHUNK_FEATURES):
+    """Set the storage layout for the datasets in a job db.
+
+    :param compression:
+      None, or one of COMPRESSION_CHOICES to compress the datasets
+      (losslessly, with the shuffle filter).
+
+    :param chunk_features:
+      Number of features in each chunk of the datasets that have a
+      row or column per feature, so that reading a range of features
+      only touches the chunks for those features. Use 0 to store
+      datasets contiguously. HDF5 can only compress chunked datasets,
+      so this must be positive if compression is given.
+
+    """
+    if compression is not None and compression not in COMPRESSION_CHOICES:
+        raise ValueError("Compression must be one of " + str(COMPRESSION_CHOICES))
+    if chunk_features < 0:
+        raise ValueError("chunk_features can't be negative")
+    if compression is not None and chunk_features == 0:
+        raise ValueError("Compressed datasets must be chunked, so "
+                         "chunk_features must be positive")
+    db.attrs['compression'] = compression or ''
+    db.attrs['chunk_features'] = chunk_features
+
+def create_dataset(db, name, shape=None, dtype=None, data=None, feature_axis=0,
+                   maxshape=None):
+    """Create a dataset in db (a file or group) using the storage
+    layout set by set_storage.
+
+    Chunks hold all of every axis except feature_axis, which is split
+    into groups of chunk_features elements. Dbs created before we had
+    storage layouts, or datasets that are empty, are stored
+    contiguously.
+
+    """
+    if data is not None:
+        data  = np.asarray(data)
+        shape = np.shape(data)
+        dtype = data.dtype if dtype is None else dtype
+
+    attrs = db.file.attrs
+    chunk_features = attrs.get('chunk_features', 0)
+    compression    = attrs.get('compression', '') or None
+
+    if maxshape is None:
+        maxshape = shape
+    resizable = [ m is None for m in maxshape ]
+    fixed_sizes = [ n for (n, r) in zip(shape, resizable) if not r ]
+
+    kwargs = {}
+
+    if chunk_features > 0 and len(shape) > 0 and min(fixed_sizes or [1]) > 0:
+        axis = feature_axis % len(shape)
+        chunks = [ n if not r else max(n, 1) for (n, r) in zip(shape, resizable) ]
+        if resizable[axis]:
+            chunks[axis] = chunk_features
+        else:
+            chunks[axis] = min(chunk_features, shape[axis])
+        kwargs['chunks'] = tuple(chunks)
+
+        if compression is not None:
+            kwargs['compression'] = compression
+            kwargs['shuffle'] = True
+
+    if any(resizable):
+        kwargs['maxshape'] = maxshape
+
+    return db.create_dataset(name, shape, dtype, data=data, **kwargs)
+
+def copy_raw_input(db, input_path, schema):
+    """Parse the input file and save its table and feature ids in db.
+
+    Grows the datasets one chunk of rows at a time so we never need to
+    hold the whole input in memory. Saving feature ids is tricky
+    because they are strings.
+
+    """
+    num_samples = len(schema.sample_column_names)
+    dt = h5py.special_dtype(vlen=str)
+    table = create_dataset(
+        db, "table", (0, num_samples), float, maxshape=(None, num_samples))
+    feature_ids = create_dataset(
+        db, "feature_ids", (0,), dt, maxshape=(None,))
+
+    for chunk in Input.iter_raw_file(input_path, schema):
+        start = len(table)
+        stop  = start + len(chunk.table)
+        table.resize(stop, axis=0)
+        feature_ids.resize((stop,))
+        table[start : stop]       = chunk.table
+        feature_ids[start : stop] = chunk.feature_ids
+        logging.info("Copied {0} rows".format(stop))
+
+def copy_dataset(src, db, name, rows=DEFAULT_CHUNK_SIZE):
+    """Copy a dataset from src into db, a block of rows at a time,
+    using db's storage layout."""
+    source = src[name]
+    dest = create_dataset(db, name, source.shape, source.dtype)
+    for start in range(0, len(source), rows):
+        dest[start : start + rows] = source[start : start + rows]
+
+def input_cache_path(input_cache_dir, input_path, schema):
+    """Returns the path of the cached, parsed copy of an input file.
+
+    The name is a hash of the contents of the file and of the columns
+    the schema reads from it, so every job that reads the same columns
+    of the same file shares one entry in the cache.
+
+    """
+    digest = hashlib.sha1()
+    with open(input_path, 'rb') as fh:
+        for block in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(block)
+
+    columns = ([ schema.feature_id_column_names[0] ] +
+               list(schema.sample_column_names))
+    digest.update("\t".join(map(str, columns)))
+
+    filename = "input_{0}.h5".format(digest.hexdigest())
+    return os.path.join(input_cache_dir, filename)
+
+def save_input_cache(db, cache_path):
+    """Save the table and feature ids from db in the input cache.
+
+    Writes to a temporary file first, so other jobs never see a
+    partially written entry.
+
+    """
+    try:
+        os.makedirs(os.path.dirname(cache_path))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise e
+
+    tmp_path = "{0}.{1}.tmp".format(cache_path, os.getpid())
+    with h5py.File(tmp_path, 'w') as cached:
+        db.copy('table', cached)
+        db.copy('feature_ids', cached)
+    os.rename(tmp_path, cache_path)
+    logging.info("Saved parsed input to cache " + cache_path)
+
 @celery.task
-def copy_input(path, input_path, schema, settings, job_id):
-    logging.info("Loading input for job from {0}".format(input_path))
-    input = Input.from_raw_file(input_path, schema)
-    logging.info("Saving input, settings, and schema to " + str(path))
+def copy_input(path, input_path, schema, settings, job_id, input_cache_dir=None,
+               compression=None, chunk_features=DEFAULT_CHUNK_FEATURES):
+    logging.info("Copying input for job from {0} to {1}".format(input_path, path))
+
+    cache_path = None
+    if input_cache_dir is not None:
+        cache_path = input_cache_path(input_cache_dir, input_path, schema)
 
     with h5py.File(path, 'w') as db:
 
-        # Save the input object
-        ids = input.feature_ids
+        # Every later step creates its datasets with this layout.
+        set_storage(db, compression, chunk_features)
 
-        # Saving feature ids is tricky because they are strings
-        dt = h5py.special_dtype(vlen=str)
-        db.create_dataset("table", data=input.table)
-        db.create_dataset("feature_ids", (len(ids),), dt)
+        # Someone already parsed the same columns of the same file, so
+        # just copy their table and feature ids.
+        if cache_path is not None and os.path.exists(cache_path):
+            logging.info("Using cached input " + cache_path)
+            with h5py.File(cache_path, 'r') as cached:
+                copy_dataset(cached, db, 'table')
+                copy_dataset(cached, db, 'feature_ids')
 
-        for i, fid in enumerate(ids):
-            input.feature_ids[i] = fid
-            db['feature_ids'][i] = fid
+        else:
+            copy_raw_input(db, input_path, schema)
+            if cache_path is not None:
+                save_input_cache(db, cache_path)
 
         print('block vars are', settings.block_variables)
 
@@ -67,6 +234,9 @@ def copy_input(path, input_path, schema, settings, job_id):
         db.attrs['summary_step_size'] = settings.summary_step_size
         db.attrs['equalize_means'] = settings.equalize_means
         db.attrs['shrink'] = settings.shrink
+        if settings.stop_tolerance is not None:
+            db.attrs['stop_tolerance'] = settings.stop_tolerance
+        db.attrs['max_batch_bytes'] = settings.max_batch_bytes
 
         # Save the schema object
         schema_str = StringIO()
@@ -80,61 +250,246 @@ def copy_input(path, input_path, schema, settings, job_id):
 def load_sample_indexes(path, sample_indexes_path):
     indexes = np.genfromtxt(sample_indexes_path, dtype=int)
     with h5py.File(path, 'r+') as db:
-        db.create_dataset("sample_indexes", data=indexes)
+        create_dataset(db, "sample_indexes", data=indexes)
 
 @celery.task(name="Generate sample indexes")
 def gen_sample_indexes(path):
+    """Save a description of the sample indexes in the job.
+
+    Only the layouts, a seed, and the number of samplings are saved;
+    whoever needs a range of the indexes constructs it from those.
+
+    """
     logging.info("Generating sample indexes for " + str(path))
-    job = load_job(path)
+    with contextlib.closing(open_job(path)) as job:
+        spec = an.new_sample_index_spec(job)
     
     with h5py.File(path, 'r+') as db:
-        indexes = an.new_sample_indexes(job)
-        db.create_dataset("sample_indexes", data=indexes)
+        db.attrs['sample_index_spec'] = spec.to_json()
+
+def read_sample_indexes(db):
+    """Return the sample indexes saved in db, or None if there are none.
+
+    The indexes are an array if they were loaded from a file, and
+    otherwise a SampleIndexSpec, which constructs them when sliced.
+
+    """
+    if 'sample_indexes' in db:
+        return db['sample_indexes'][...]
+    elif 'sample_index_spec' in db.attrs:
+        return SampleIndexSpec.from_json(db.attrs['sample_index_spec'])
+    else:
+        return None
 
 @celery.task
-def compute_raw_stats(path):
+def compute_raw_stats(path, num_shards=1, chunk_size=DEFAULT_CHUNK_SIZE):
     logging.info("Computing raw statistics")
 
-    job = load_job(path)
-
-    raw_stats    = job.get_stat_fn()(job.input.table)
-    coeff_values = an.compute_coeffs(job)
-    fold_change  = an.compute_fold_change(job)
-    group_means  = an.compute_means(job)
+    # Load everything except the input table, which we read in chunks
+    # of features so that we never hold the statistics for the whole
+    # table in memory at once.
+    job = load_job(path, 0, 0)
+
+    pool = None
+    map_fn = map
+    if num_shards > 1:
+        logging.info("  Using a pool of " + str(num_shards) + " processes")
+        pool = multiprocessing.Pool(num_shards)
+        map_fn = pool.map
+
+    try:
+        with h5py.File(path, 'r+') as db:
+            table = db['table']
+            ids   = db['feature_ids']
+            num_features = len(table)
+
+            # Fold change uses a constant that depends on the whole
+            # table, so find it once up front, a chunk at a time.
+            alpha = an.fold_change_alpha(table, chunk_size)
+
+            chunks = [ (start, min(start + chunk_size, num_features))
+                       for start in range(0, num_features, chunk_size) ]
+
+            # Only read as many chunks as we have processes at a time.
+            for i in range(0, len(chunks), num_shards):
+                wave = chunks[i : i + num_shards]
+                args = [ (job, table[start : stop], ids[start : stop], alpha)
+                         for (start, stop) in wave ]
+                for ((start, stop), res, arg) in zip(wave, map_fn(_raw_stats_chunk, args), args):
+                    logging.debug("  Saving raw statistics for features " +
+                                  str(start) + " to " + str(stop))
+                    save_raw_stats_chunk(db, res, arg[1], start, stop, num_features)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+def _raw_stats_chunk(args):
+    (job, table, feature_ids, alpha) = args
+    job.input = Input(table, feature_ids)
+    return an.compute_raw_stats(job, fold_change_alpha=alpha)
+
+def save_raw_stats_chunk(db, res, table, start, stop, num_features):
+    """Copy the raw stats for one chunk of features into the job db.
+
+    Also saves the mean and variance of each feature in the chunk of
+    the input table, so that views don't need to read the whole
+    table to get them. Creates the datasets, sized for all the
+    features, when given the first chunk.
+
+    """
+    (raw_stats, coeff_values, fold_change, group_means) = res
+
+    if 'raw_stats' not in db:
+        shape = np.shape(raw_stats)[:-1] + (num_features,)
+        create_dataset(db, "raw_stats", shape, float, feature_axis=-1)
+        for (name, t) in [ ('group_means', group_means),
+                           ('fold_change', fold_change),
+                           ('coeff_values', coeff_values) ]:
+            create_table(db, name, t.header, (num_features,) + np.shape(t.table)[1:])
+        create_dataset(db, "feature_means", (num_features,), float)
+        create_dataset(db, "feature_variances", (num_features,), float)
+
+    db['raw_stats'][..., start : stop] = raw_stats
+    db['group_means'][start : stop]  = group_means.table
+    db['fold_change'][start : stop]  = fold_change.table
+    db['coeff_values'][start : stop] = coeff_values.table
+    db['feature_means'][start : stop]     = np.mean(table, axis=-1)
+    db['feature_variances'][start : stop] = np.var(table, axis=-1)
+
+def read_num_samples_used(db):
+    """Return the number of samples the permutation counts came from."""
+    if 'num_samples_used' in db.attrs:
+        return int(db.attrs['num_samples_used'])
+    else:
+        return None
 
-    with h5py.File(path, 'r+') as db:
-        db.create_dataset("raw_stats", data=raw_stats)
-        save_table(db, group_means, 'group_means')
-        save_table(db, fold_change, 'fold_change')
-        save_table(db, coeff_values, 'coeff_values')
-        
 @celery.task
 def choose_bins(path):
     logging.info("Choosing bins for discretized statistic space")
-    job = load_job(path)
-    bins = bins_uniform(job.settings.num_bins, job.results.raw_stats)
+    with contextlib.closing(open_job(path)) as job:
+        bins = bins_uniform(job.settings.num_bins, job.results.raw_stats)
     with h5py.File(path, 'r+') as db:
         db.create_dataset("bins", data=bins)
 
 
 @celery.task
-def compute_mean_perm_count(path):
+def compute_mean_perm_count(path, num_shards=1):
     logging.info("Computing mean permutation counts")
+
+    with h5py.File(path, 'r') as db:
+        adaptive = 'stop_tolerance' in db.attrs
+
+    if adaptive:
+        compute_mean_perm_count_adaptive(path, num_shards)
+
+    elif num_shards > 1:
+        logging.info("  Using a pool of " + str(num_shards) + " processes")
+        pool = multiprocessing.Pool(num_shards)
+        try:
+            counts = pool.map(
+                _perm_count_shard,
+                [ (path, i, num_shards) for i in range(num_shards) ])
+        finally:
+            pool.close()
+            pool.join()
+        save_mean_perm_count(path, counts)
+
+    else:
+        job = load_job(path)
+        bin_to_mean_perm_count = an.compute_mean_perm_count(job)
+        with h5py.File(path, 'r+') as db:
+            db.create_dataset("bin_to_mean_perm_count", data=bin_to_mean_perm_count)
+            db.attrs['num_samples_used'] = len(job.results.sample_indexes)
+
+def compute_mean_perm_count_adaptive(path, num_shards=1):
+    """Compute the mean permutation counts, stopping once the summary settles.
+
+    See pade.analysis.adaptive_mean_perm_count. With more than one
+    shard, each round of samples is split across a local process
+    pool, whose processes each load the job once for all the rounds.
+
+    """
+    pool = None
+    count_fn = None
+    if num_shards > 1:
+        logging.info("  Using a pool of " + str(num_shards) + " processes")
+        pool = multiprocessing.Pool(num_shards,
+                                    initializer=_init_perm_count_worker,
+                                    initargs=(path,))
+
+        def count_fn(start, stop):
+            ranges = [ an.shard_range(stop - start, i, num_shards)
+                       for i in range(num_shards) ]
+            counts = pool.map(
+                _perm_count_range,
+                [ (start + a, start + b) for (a, b) in ranges ])
+            return np.sum(counts, axis=0)
+
+    try:
+        with contextlib.closing(open_job(path)) as job:
+            (mean, num_used) = an.adaptive_mean_perm_count(job, count_fn)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    with h5py.File(path, 'r+') as db:
+        db.create_dataset("bin_to_mean_perm_count", data=mean)
+        db.attrs['num_samples_used'] = num_used
+
+@celery.task
+def compute_perm_count_shard(path, shard, num_shards):
+    """Returns the summed permutation counts for one shard of the permutations."""
+    logging.info("Computing permutation counts for shard {0} of {1}".format(
+            shard + 1, num_shards))
     job = load_job(path)
-    bin_to_mean_perm_count = an.compute_mean_perm_count(job)
+    (start, stop) = an.shard_range(
+        len(job.results.sample_indexes), shard, num_shards)
+    return an.compute_perm_count(job, start, stop)
+
+@celery.task
+def merge_perm_counts(counts, path):
+    """Sums the counts returned by all the shards and saves the mean."""
+    logging.info("Merging permutation counts from " + str(len(counts)) + " shards")
+    save_mean_perm_count(path, counts)
+
+def _perm_count_shard(args):
+    # Pool.map only passes one argument, and the function must be
+    # defined at module level so it can be pickled.
+    return compute_perm_count_shard(*args)
+
+# The job and its permutation inputs, loaded once in each process of
+# the adaptive pool by _init_perm_count_worker.
+_worker_job = None
+_worker_inputs = None
+
+def _init_perm_count_worker(path):
+    global _worker_job, _worker_inputs
+    _worker_job = load_job(path)
+    _worker_inputs = an.perm_count_inputs(_worker_job)
+
+def _perm_count_range(args):
+    (start, stop) = args
+    return an.compute_perm_count(_worker_job, start, stop, _worker_inputs)
+
+def save_mean_perm_count(path, counts):
     with h5py.File(path, 'r+') as db:
-        db.create_dataset("bin_to_mean_perm_count", data=bin_to_mean_perm_count)
+        num_perms = len(read_sample_indexes(db))
+        db.create_dataset("bin_to_mean_perm_count",
+                          data=np.sum(counts, axis=0) / num_perms)
+        db.attrs['num_samples_used'] = num_perms
 
 
 @celery.task
 def compute_conf_scores(path):
     logging.info("Computing confidence scores")
-    job = load_job(path)
-    raw  = job.results.raw_stats
-    bins = job.results.bins
+    with contextlib.closing(open_job(path)) as job:
+        raw  = job.results.raw_stats
+        bins = job.results.bins
+        perm_counts = job.results.bin_to_mean_perm_count
     
     unperm_counts = cumulative_hist(raw, bins)
-    perm_counts   = job.results.bin_to_mean_perm_count
     bin_to_score  = confidence_scores(unperm_counts, perm_counts, np.shape(raw)[-1])
     feature_to_score = assign_scores_to_features(
         raw, bins, bin_to_score)
@@ -142,14 +497,17 @@ def compute_conf_scores(path):
     with h5py.File(path, 'r+') as db:
         db.create_dataset("bin_to_unperm_count", data=unperm_counts)
         db.create_dataset("bin_to_score", data=bin_to_score)
-        db.create_dataset("feature_to_score", data=feature_to_score)
+        create_dataset(db, "feature_to_score", data=feature_to_score,
+                       feature_axis=-1)
+        create_dataset(db, "feature_best_score",
+                       data=np.max(feature_to_score, axis=0))
 
 
 @celery.task
 def summarize_by_conf_level(path):
     logging.info("Summarizing counts by confidence level")
-    job = load_job(path)
-    summary = an.summary_by_conf_level(job)
+    with contextlib.closing(open_job(path)) as job:
+        summary = an.summary_by_conf_level(job)
 
     with h5py.File(path, 'r+') as db:
         grp = db.create_group('summary')
@@ -157,29 +515,77 @@ def summarize_by_conf_level(path):
         grp['best_param_idxs'] = summary.best_param_idxs
         grp['counts']          = summary.counts
 
+    save_summary_index(path, summary)
+
+def summary_index_path(path):
+    """Path of the small file holding the summary of the job at path."""
+    return os.path.splitext(path)[0] + '.summary.json'
+
+def save_summary_index(path, summary):
+    """Save the summary next to the job, so views that compare jobs
+    don't need to open the job itself."""
+    index_path = summary_index_path(path)
+    tmp_path = "{0}.{1}.tmp".format(index_path, os.getpid())
+    with open(tmp_path, 'w') as out:
+        json.dump({ 'bins'            : summary.bins.tolist(),
+                    'best_param_idxs' : summary.best_param_idxs.tolist(),
+                    'counts'          : summary.counts.tolist() },
+                  out)
+    os.rename(tmp_path, index_path)
+
+def load_summary_index(path):
+    """Load the summary of the job at path, or None if it has none yet.
+
+    Jobs that were summarized before we kept a summary index, or that
+    were imported, are read once and their index saved if possible.
+
+    """
+    try:
+        with open(summary_index_path(path)) as f:
+            doc = json.load(f)
+        return Summary(np.array(doc['bins']),
+                       np.array(doc['best_param_idxs']),
+                       np.array(doc['counts']))
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise e
+
+    with h5py.File(path, 'r') as db:
+        summary = load_summary(db)
+
+    if summary is not None:
+        try:
+            save_summary_index(path, summary)
+        except (IOError, OSError) as e:
+            logging.warn("Couldn't save summary index for " + path + 
+                         ": " + str(e))
+    return summary
+
         
 @celery.task
 def compute_orderings(path):
 
     logging.info("Computing orderings of features")
-    job = load_job(path)
-    original = np.arange(len(job.input.feature_ids))
-    stats = job.results.feature_to_score[...]
+    with contextlib.closing(open_job(path)) as job:
+        stats = job.results.feature_to_score
+        fold_change = job.results.fold_change
+
+    original = np.arange(np.shape(stats)[-1])
     rev_stats = 0.0 - stats
 
     logging.info("  Computing ordering by score for each tuning param")
-    by_score_original = np.zeros(np.shape(job.results.raw_stats), int)
-    for i in range(len(job.settings.tuning_params)):
+    by_score_original = np.zeros(np.shape(stats), int)
+    for i in range(len(stats)):
         by_score_original[i] = np.lexsort(
             (original, rev_stats[i]))
 
     order_by_score_original = by_score_original
 
     logging.info("  Computing ordering by fold change")
-    by_foldchange_original = np.zeros(np.shape(job.results.fold_change.table), int)
-    foldchange = job.results.fold_change.table[...]
+    by_foldchange_original = np.zeros(np.shape(fold_change.table), int)
+    foldchange = fold_change.table
     rev_foldchange = 0.0 - foldchange
-    for i in range(len(job.results.fold_change.header)):
+    for i in range(len(fold_change.header)):
         keys = (original, rev_foldchange[..., i])
 
         by_foldchange_original[..., i] = np.lexsort(keys)
@@ -188,22 +594,51 @@ def compute_orderings(path):
 
     with h5py.File(path, 'r+') as db:
         orderings = db.create_group('orderings')
-        orderings['by_score_original'] = order_by_score_original
-        orderings['by_foldchange_original'] = order_by_foldchange_original        
+        create_dataset(orderings, 'by_score_original',
+                       data=order_by_score_original, feature_axis=-1)
+        create_dataset(orderings, 'by_foldchange_original',
+                       data=order_by_foldchange_original)
 
 
-def steps(settings, schema, infile_path, sample_indexes_path, path, job_id):
+def steps(settings, schema, infile_path, sample_indexes_path, path, job_id,
+          num_shards=1, distrib=False, input_cache_dir=None,
+          compression=None, chunk_features=DEFAULT_CHUNK_FEATURES):
 
-    do_copy_input = copy_input.si(path, infile_path, schema, settings, job_id)
+    do_copy_input = copy_input.si(
+        path, infile_path, schema, settings, job_id, input_cache_dir,
+        compression, chunk_features)
     
     if sample_indexes_path is not None:
         make_sample_indexes = load_sample_indexes.si(path, os.path.abspath(sample_indexes_path))
     else:
         make_sample_indexes = gen_sample_indexes.si(path)
 
+    # The raw stats for all the chunks are written to the same job
+    # file, so they're one task. A Celery worker can't start a process
+    # pool of its own, so that task only shards when we run locally.
+    raw_stats_shards = 1 if distrib else num_shards
+
+    # If we're distributing the work, each shard of the permutations
+    # is its own task, and we merge the results once they're all
+    # done. Otherwise we run the shards in a local process pool. When
+    # we may stop early, each round of samples has to finish before we
+    # know whether to start the next, so that runs as one task. A
+    # Celery worker can't start a process pool of its own, so that task
+    # doesn't shard when we're distributing.
+    if distrib and settings.stop_tolerance is not None:
+        do_mean_perm_count = compute_mean_perm_count.si(path, 1)
+    elif distrib and num_shards > 1:
+        do_mean_perm_count = chord(
+            [ compute_perm_count_shard.si(path, i, num_shards)
+              for i in range(num_shards) ],
+            merge_perm_counts.s(path))
+    else:
+        do_mean_perm_count = compute_mean_perm_count.si(path, num_shards)
+
     return [
 
-        # First we need to load the input table.
+        # First we need to load the input table, or copy it from the
+        # input cache if we've already parsed the same file.
         do_copy_input,
 
         # Then construct (or load) a list of permutations of the indexes
@@ -211,19 +646,16 @@ def steps(settings, schema, infile_path, sample_indexes_path, path, job_id):
 
         # Then compute the raw statistics (f-test or other
         # differential expression stat, means, fold change, and
-        # coefficients). We should be able to chunk this up. We would
-        # then simply need to copy the chunk results into the master
-        # job db.
-        compute_raw_stats.si(path),
+        # coefficients), in chunks of features.
+        compute_raw_stats.si(path, raw_stats_shards),
 
         # Choose bins for our histogram based on the values of the raw
-        # stats. We would need to merge all of the above chunks first.
+        # stats.
         choose_bins.si(path),
 
         # Then run the permutations and come up with cumulative
-        # counts. This can be chunked. We would need to add another
-        # step that merges the results together.
-        compute_mean_perm_count.si(path),
+        # counts, possibly split into shards that get merged together.
+        do_mean_perm_count,
 
         # Compare the unpermuted counts to the mean permuted counts to
         # come up with confidence scores.
@@ -243,21 +675,151 @@ def timing(msg):
     end = time.time()
     logging.info(msg + " (" + str(end - start) + " seconds)")
 
-def load_input(db):
-    return Input(db['table'][...],
-                 db['feature_ids'][...])
+def load_input(db, start=None, stop=None):
+    return Input(db['table'][start : stop],
+                 db['feature_ids'][start : stop])
 
-def load_job(path):
+def load_job(path, start=None, stop=None):
+    """Load the job from the given path.
+
+    Supply start and stop to only load that range of rows of the
+    input table.
+
+    """
     with timing("Loaded job from " + path):
         with h5py.File(path, 'r') as db:
             return Job(
                 job_id = db.attrs['job_id'],
                 settings=load_settings(db),
-                input=load_input(db),
+                input=load_input(db, start, stop),
                 schema=load_schema(db),
                 results=load_results(db),
                 summary=load_summary(db))
 
+def open_job(path, start=None, stop=None):
+    """Open the job at the given path without reading its datasets.
+
+    The settings, schema, and summary are read right away. The input
+    and results are read from the open file the first time each of
+    them is used, and then kept in memory. Supply start and stop to
+    only read that range of rows of the input table.
+
+    The caller should close the job when done with it, for example
+    with contextlib.closing. Anything that hasn't been read by then
+    is read by briefly reopening the file.
+
+    """
+    db = h5py.File(path, 'r')
+    try:
+        return Job(
+            job_id = db.attrs['job_id'],
+            settings=load_settings(db),
+            input=LazyInput(db, start, stop),
+            schema=load_schema(db),
+            results=LazyResults(db),
+            summary=load_summary(db),
+            db=db)
+    except:
+        db.close()
+        raise
+
+class LazyDataset(object):
+    """An attribute that reads a dataset from the object's db the first
+    time it's accessed.
+
+    Reads from the object's open db if it has one, and otherwise opens
+    the file at its path just long enough to read the dataset. The
+    value read is stored on the object, where it hides this
+    descriptor, so each dataset is read at most once and can be
+    replaced by assignment. Missing datasets read as None. Supply
+    reader to read the value with a function of the db instead.
+
+    """
+    def __init__(self, attr, name, table=False, rows=False, reader=None):
+        self.attr   = attr
+        self.name   = name
+        self.table  = table
+        self.rows   = rows
+        self.reader = reader
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+
+        # A closed h5py File is false
+        if obj.db:
+            value = self.read(obj, obj.db)
+        else:
+            with h5py.File(obj.path, 'r') as db:
+                value = self.read(obj, db)
+
+        obj.__dict__[self.attr] = value
+        return value
+
+    def read(self, obj, db):
+        if self.reader is not None:
+            return self.reader(db)
+        elif self.table:
+            return load_table(db, self.name)
+        elif self.name not in db:
+            return None
+        elif self.rows:
+            return db[self.name][obj.start : obj.stop]
+        else:
+            return db[self.name][...]
+
+def loaded_nbytes(job):
+    """Number of bytes of datasets a lazily opened job has read so far."""
+    total = 0
+    for obj in (job.input, job.results):
+        for value in vars(obj).values():
+            if isinstance(value, TableWithHeader):
+                value = value.table
+            if isinstance(value, np.ndarray):
+                total += value.nbytes
+    return total
+
+class LazyInput(Input):
+    """Input that is read from a job db when it's first used."""
+
+    table       = LazyDataset('table', 'table', rows=True)
+    feature_ids = LazyDataset('feature_ids', 'feature_ids', rows=True)
+
+    def __init__(self, db, start=None, stop=None):
+        self.db    = db
+        self.path  = db.filename
+        self.start = start
+        self.stop  = stop
+
+class LazyResults(Results, object):
+    """Results that are read from a job db as they're used."""
+
+    bins                   = LazyDataset('bins', 'bins')
+    bin_to_unperm_count    = LazyDataset('bin_to_unperm_count', 'bin_to_unperm_count')
+    bin_to_mean_perm_count = LazyDataset('bin_to_mean_perm_count', 'bin_to_mean_perm_count')
+    bin_to_score           = LazyDataset('bin_to_score', 'bin_to_score')
+    feature_to_score       = LazyDataset('feature_to_score', 'feature_to_score')
+    feature_best_score     = LazyDataset('feature_best_score', 'feature_best_score')
+    feature_means          = LazyDataset('feature_means', 'feature_means')
+    feature_variances      = LazyDataset('feature_variances', 'feature_variances')
+    raw_stats              = LazyDataset('raw_stats', 'raw_stats')
+    sample_indexes         = LazyDataset('sample_indexes', 'sample_indexes',
+                                         reader=read_sample_indexes)
+    num_samples_used       = LazyDataset('num_samples_used', 'num_samples_used',
+                                         reader=read_num_samples_used)
+    group_means            = LazyDataset('group_means', 'group_means', table=True)
+    coeff_values           = LazyDataset('coeff_values', 'coeff_values', table=True)
+    fold_change            = LazyDataset('fold_change', 'fold_change', table=True)
+
+    ordering_by_score_original = LazyDataset(
+        'ordering_by_score_original', 'orderings/by_score_original')
+    ordering_by_foldchange_original = LazyDataset(
+        'ordering_by_foldchange_original', 'orderings/by_foldchange_original')
+
+    def __init__(self, db):
+        self.db   = db
+        self.path = db.filename
+
 def load_settings(db):
 
     if 'equalize_means_ids' in db:
@@ -284,7 +846,10 @@ def load_settings(db):
         tuning_params = db['tuning_params'][...],
         equalize_means_ids = equalize_means_ids,
         equalize_means = db.attrs['equalize_means'],
-        shrink = db.attrs['shrink'])
+        shrink = db.attrs['shrink'],
+        stop_tolerance = db.attrs.get('stop_tolerance'),
+        max_batch_bytes = db.attrs.get('max_batch_bytes',
+                                       DEFAULT_MAX_BATCH_BYTES))
 
 def load_table(db, name):
     if name in db:
@@ -323,12 +888,16 @@ def load_results(db):
     
     if 'feature_to_score' in db:
         results.feature_to_score = db['feature_to_score'][...]
+
+    for name in ['feature_best_score', 'feature_means', 'feature_variances']:
+        if name in db:
+            setattr(results, name, db[name][...])
     
     if 'raw_stats' in db:
         results.raw_stats = db['raw_stats'][...]
 
-    if 'sample_indexes' in db:
-        results.sample_indexes = db['sample_indexes'][...]
+    results.sample_indexes = read_sample_indexes(db)
+    results.num_samples_used = read_num_samples_used(db)
 
     # Group means, coefficients, and fold change, with the header information
     results.group_means  = load_table(db, 'group_means')
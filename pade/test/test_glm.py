@@ -61,3 +61,96 @@ class GlmTestCase(unittest.TestCase):
 
         
         
+    def test_fit_wls_shared_exog(self):
+        np.random.seed(0)
+        weights = np.random.random((5, 24)) + 0.5
+        endog   = np.random.random((5, 24))
+        exog    = np.array(self.exog, float)
+
+        (beta, cov_p) = glm.fit_wls(endog, exog, weights)
+
+        for i in range(5):
+            w = np.sqrt(weights[i])
+            pinv = np.linalg.pinv(w[:, None] * exog)
+            np.testing.assert_almost_equal(beta[i], np.dot(pinv, w * endog[i]))
+            np.testing.assert_almost_equal(cov_p[i], np.dot(pinv, pinv.T))
+
+        # Giving each model its own copy of exog is the same
+        (beta_3d, cov_p_3d) = glm.fit_wls(endog, np.array([exog] * 5), weights)
+        np.testing.assert_almost_equal(beta, beta_3d)
+        np.testing.assert_almost_equal(cov_p, cov_p_3d)
+
+    def test_fit_wls_singular(self):
+        endog = np.random.random((2, 24))
+        exog  = np.column_stack([self.exog, self.exog[:, 1]])
+
+        (beta, cov_p) = glm.fit_wls(endog, exog)
+
+        pinv = np.linalg.pinv(exog)
+        for i in range(2):
+            np.testing.assert_almost_equal(beta[i], np.dot(pinv, endog[i]))
+
+    def test_iterations(self):
+        # With the identity link the first fit is exact, and the
+        # second one just confirms that the deviance has converged.
+        glm_res = glm.fit_glm(self.input, self.exog, self.families['gaussian'])
+        np.testing.assert_equal(glm_res.iterations, 2)
+
+        glm_res = glm.fit_glm(self.input, self.exog, self.families['poisson'])
+        self.assertEquals(np.shape(glm_res.iterations), (len(self.input),))
+        self.assertTrue(np.all(glm_res.iterations >= 2))
+
+        capped = glm.fit_glm(self.input, self.exog, self.families['poisson'],
+                             maxiter=1)
+        np.testing.assert_equal(capped.iterations,
+                                np.minimum(glm_res.iterations, 2))
+
+    def test_all_zero_group(self):
+        # When one group is all zeros, the deviance stops changing
+        # while the coefficients keep heading off to infinity, so the
+        # statistic depends on when we stop. It should stop when the
+        # rows used to stop all being fit together, giving the same
+        # statistics they did before.
+        zeros = np.array([ [0] * 12 + [3, 1, 4, 1, 5, 9, 2, 6, 5, 3, 5, 8] ])
+        endog = np.concatenate([ self.input, zeros ])
+
+        expected = { 'poisson' : 2.2648926453056388,
+                     'negative_binomial' : 6.1858273074765079e-06 }
+
+        for (name, f_value) in expected.items():
+            glm_res = glm.fit_glm(endog, self.exog, self.families[name])
+            f = glm.f_test(glm_res.beta, self.contrast,
+                           glm_res.normalized_cov_params, glm_res.scale)
+            f = np.reshape(f, (len(f),))
+            np.testing.assert_allclose(f[-1], f_value, rtol=1e-5)
+
+            # The other rows aren't affected
+            if name == 'poisson':
+                np.testing.assert_almost_equal(
+                    f[:-1], np.genfromtxt('pade/test/glm/poisson_f_values.txt'))
+
+    def test_f_test_general_contrast(self):
+        np.random.seed(0)
+        betas  = np.random.random((4, 3))
+        cov_ps = np.random.random((4, 3, 3))
+        cov_ps = np.matmul(cov_ps, cov_ps.transpose(0, 2, 1)) + np.eye(3)
+        scale  = np.random.random(4) + 0.5
+        r_matrix = np.array([ [0, 1, 0], [0, 0, 1] ])
+        alphas = np.array([0.0, 0.5, 3.0])
+
+        def expected(a):
+            res = np.zeros(4)
+            for i in range(4):
+                rb = np.dot(r_matrix, betas[i])
+                cov = np.dot(r_matrix, np.dot(cov_ps[i] * scale[i] + a, r_matrix.T))
+                res[i] = np.dot(rb, np.dot(np.linalg.inv(cov), rb)) / 2
+            return res
+
+        f = glm.f_test(betas, r_matrix, cov_ps, scale)
+        self.assertEquals(np.shape(f), (4, 1, 1))
+        np.testing.assert_almost_equal(f.reshape(4), expected(0.0))
+
+        f = glm.f_test(betas, r_matrix, cov_ps, scale, smoothing=alphas)
+        self.assertEquals(np.shape(f), (3, 4, 1, 1))
+        for (j, a) in enumerate(alphas):
+            np.testing.assert_almost_equal(f[j].reshape(4), expected(a))
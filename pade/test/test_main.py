@@ -1,6 +1,7 @@
 import unittest
 
 from pade.main import *
+from pade.test.utils import tempdir
 
 class MainTest(unittest.TestCase):
 
@@ -43,5 +44,52 @@ class MainTest(unittest.TestCase):
         self.assertEquals('"a"', quote_and_join(['a']))
         self.assertEquals('"a" and "b"', quote_and_join(['a', 'b']))
 
+    def test_save_output(self):
+        with open('sample_jobs/two_cond/pade_schema.yaml') as f:
+            schema = Schema.load(f)
+        settings = Settings(stat='f', num_samples=10,
+                            condition_variables=['treated'])
+
+        with tempdir() as tmp:
+            path = os.path.join(tmp, 'job.pade')
+            pade.tasks.copy_input(
+                path, 'sample_jobs/two_cond/sample_data_2_cond.txt',
+                schema, settings, 0)
+            for task in [ pade.tasks.gen_sample_indexes,
+                          pade.tasks.compute_raw_stats,
+                          pade.tasks.choose_bins,
+                          pade.tasks.compute_mean_perm_count,
+                          pade.tasks.compute_conf_scores ]:
+                task(path)
+
+            job = pade.tasks.load_job(path)
+            text_path = os.path.join(tmp, 'report.txt')
+            save_text_output(job, text_path)
+
+            # Reading from the open job in chunks, gzipped
+            gz_path = os.path.join(tmp, 'report.txt.gz')
+            npz_path = os.path.join(tmp, 'report.npz')
+            with contextlib.closing(pade.tasks.open_job(path)) as opened:
+                save_text_output(opened, gz_path, chunk_size=7)
+                save_npz_output(opened, npz_path, chunk_size=7)
+
+            with open(text_path) as a, gzip.open(gz_path) as b:
+                self.assertEquals(a.read(), b.read())
+
+            with open(text_path) as f:
+                header = f.next().rstrip().split("\t")
+                rows = [ line.rstrip().split("\t") for line in f ]
+
+            npz = np.load(npz_path)
+            self.assertEquals(list(npz['columns']), header[1:])
+            self.assertEquals(list(npz['feature_ids']), [ r[0] for r in rows ])
+            np.testing.assert_almost_equal(
+                npz['values'],
+                [ map(float, r[1:]) for r in rows ], decimal=6)
+
+            best = np.max(job.results.feature_to_score, axis=0)
+            np.testing.assert_equal(
+                npz['values'][:, header.index('best_score') - 1], best)
+
 if __name__ == '__main__':
     unittest.main()
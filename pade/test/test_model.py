@@ -3,7 +3,7 @@ import numpy as np
 from pade.test.utils import sample_db
 from pade.model import (
     Model, Schema, ModelExpression, ModelExpressionException, Settings, Job,
-    InvalidSettingsException)
+    Input, InvalidSettingsException)
 from pade.main import init_schema
 from pade.stat import UnsupportedLayoutException, UnknownStatisticException
 from StringIO import StringIO
@@ -68,6 +68,26 @@ class OtherTest(unittest.TestCase):
             self.assertEquals(np.shape(job.input.table), (1000, 16))
 
 
+    def test_iter_raw_file(self):
+        with open(self.sample_input_4_class) as infile:
+            schema = init_schema(infile)
+        expected = np.genfromtxt(self.sample_input_4_class, skip_header=1)
+
+        chunks = list(Input.iter_raw_file(
+                self.sample_input_4_class, schema, chunk_size=300))
+        self.assertEquals([ len(c.table) for c in chunks ], [300, 300, 300, 100])
+        np.testing.assert_almost_equal(
+            np.concatenate([ c.table for c in chunks ]), expected[:, 1:])
+
+        input = Input.from_raw_file(self.sample_input_4_class, schema)
+        self.assertEquals(np.shape(input.table), (1000, 16))
+        np.testing.assert_equal(
+            input.feature_ids,
+            np.concatenate([ c.feature_ids for c in chunks ]))
+
+        input = Input.from_raw_file(self.sample_input_4_class, schema, limit=1)
+        self.assertEquals(np.shape(input.table), (2, 16))
+
     def test_model_to_layout(self):
 
         with sample_db(self.sample_input_4_class,
@@ -4,6 +4,8 @@ from redis import Redis
 from pade.http.server import PadeViewer, PadeRunner
 
 from pade.http.newjob import parse_stat
+from pade.model import Schema, Settings
+from pade.tasks import copy_input
 
 import pade.http.jobdetails
 import pade.config
@@ -14,6 +16,8 @@ import os
 import redis.exceptions
 import logging
 
+from multiprocessing.pool import ThreadPool
+
 standard_routes = [
     '/',
     '/jobs',
@@ -57,6 +61,123 @@ class PadeViewerTestCase(unittest.TestCase):
         for route in ['/jobs/0/features/14/interaction_plot']:
             self.assertStatus(route, 404)
 
+def make_input_jobs(directory, names):
+    """Make jobs that have just their input copied, at the given
+    names in directory."""
+    paths = []
+    with open('sample_jobs/two_cond/pade_schema.yaml') as f:
+        schema = Schema.load(f)
+    for (job_id, name) in enumerate(names):
+        path = os.path.join(directory, name)
+        copy_input(path, 'sample_jobs/two_cond/sample_data_2_cond.txt',
+                   schema, Settings(stat='f'), job_id)
+        paths.append(path)
+    return paths
+
+class JobCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.paths = make_input_jobs(self.tmp, ['a.pade', 'b.pade'])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_get(self):
+        cache = pade.http.jobdetails.JobCache()
+        (a, b) = self.paths
+        job = cache.get(a)
+        self.assertTrue(cache.get(a) is job)
+        self.assertFalse(cache.get(b) is job)
+
+        # Changing the file reloads it
+        mtime = os.path.getmtime(a)
+        os.utime(a, (mtime + 10, mtime + 10))
+        self.assertFalse(cache.get(a) is job)
+
+    def test_trim(self):
+        cache = pade.http.jobdetails.JobCache(max_bytes=0)
+        (a, b) = self.paths
+        cache.get(a).input.table
+        cache.get(b).input.table
+        cache.trim()
+        self.assertEquals(list(cache.jobs), [b])
+
+        # Never drop the job we just used
+        cache.trim()
+        self.assertEquals(list(cache.jobs), [b])
+
+class PlotCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        (path,) = make_input_jobs(self.tmp, ['a.pade'])
+        self.app = PadeViewer().test_client()
+        pade.http.jobdetails.job_dbs = [ JobMeta(0, 'a', path, imported=True) ]
+        pade.http.jobdetails.plot_cache_dir = os.path.join(self.tmp, 'plots')
+
+    def tearDown(self):
+        pade.http.jobdetails.plot_cache_dir = None
+        pade.http.jobdetails.plot_cache = pade.http.jobdetails.PlotCache()
+        shutil.rmtree(self.tmp)
+
+    def plot_files(self):
+        cache_dir = pade.http.jobdetails.plot_cache_dir
+        return [ os.path.join(root, name)
+                 for (root, dirs, names) in os.walk(cache_dir)
+                 for name in names ]
+
+    def test_cached_plot(self):
+        route = '/jobs/0/features/3/measurement_scatter'
+        first = self.app.get(route)
+        self.assertEquals(first.status_code, 200)
+        self.assertEquals(first.mimetype, 'image/png')
+        etag = first.headers['ETag']
+        self.assertEquals(len(self.plot_files()), 1)
+
+        second = self.app.get(route)
+        self.assertEquals(second.data, first.data)
+        self.assertEquals(second.headers['ETag'], etag)
+
+        not_modified = self.app.get(route, headers={ 'If-None-Match' : etag })
+        self.assertEquals(not_modified.status_code, 304)
+
+        # Different arguments are different plots
+        other = self.app.get('/jobs/0/features/4/measurement_scatter')
+        self.assertNotEquals(other.headers['ETag'], etag)
+
+    def test_plot_cache_bound(self):
+        route = '/jobs/0/features/{0}/measurement_scatter'
+        size = len(self.app.get(route.format(0)).data)
+
+        # Room for about two plots
+        bound = size * 5 // 2
+        pade.http.jobdetails.plot_cache = pade.http.jobdetails.PlotCache(bound)
+        for feature in range(1, 5):
+            self.app.get(route.format(feature))
+            paths = self.plot_files()
+            self.assertTrue(sum(map(os.path.getsize, paths)) <= bound)
+        self.assertTrue(0 < len(paths) < 4)
+
+        # The plots for jobs that are gone are removed
+        (other,) = make_input_jobs(self.tmp, ['b.pade'])
+        pade.http.jobdetails.job_dbs = [ JobMeta(0, 'b', other, imported=True) ]
+        self.app.get(route.format(0))
+        self.assertEquals(len(self.plot_files()), 1)
+
+    def test_concurrent_rendering(self):
+        pade.http.jobdetails.plot_cache_dir = None
+        routes = [ '/jobs/0/features/{0}/{1}'.format(feature, plot)
+                   for feature in range(4)
+                   for plot in ['measurement_scatter', 'measurement_bars'] ]
+        get = lambda route: self.app.get(route).data
+        serial = map(get, routes)
+        pool = ThreadPool(4)
+        try:
+            self.assertEquals(pool.map(get, routes), serial)
+        finally:
+            pool.close()
+
 class PadeRunnerTestCase(unittest.TestCase):
     
     def setUp(self):
@@ -1,7 +1,11 @@
 import numpy as np
+import scipy.stats
 import unittest
 from pade.stat import *
-from pade.layout import random_orderings, num_orderings, all_orderings
+from pade.layout import (
+    random_orderings, num_orderings, all_orderings, block_groups,
+    unrank_ordering, random_indexes, random_ranks, SampleIndexSpec)
+from math import factorial
 
 def pairedOrderings(n, R):
     idxs = np.arange(2 * n)
@@ -53,6 +57,22 @@ class StatTest(unittest.TestCase):
 
         self.assertAlmostEqual(expected, ftest(self.ftest_in)[0])
 
+    def test_ftest_matches_rss(self):
+        np.random.seed(0)
+        data = np.random.gamma(2, 10, (4, 30, 12)) + 1000.0
+        conds  = [ [0, 1, 2, 6, 7, 8], [3, 4, 5, 9, 10, 11] ]
+        blocks = [ range(6), range(6, 12) ]
+        full = intersect_layouts(blocks, conds)
+
+        rss_full = rss(data, full)
+        rss_red  = rss(data, blocks)
+        expected = ((rss_red - rss_full) / (len(full) - len(blocks)) /
+                    (rss_full / (12 - len(full))))
+
+        ftest = FStat(conds, blocks)
+        np.testing.assert_almost_equal(ftest(data), expected)
+        np.testing.assert_almost_equal(ftest(data[0]), expected[0])
+
     def test_num_orderings(self):
 
         def assertOrderings(full, reduced, expected):
@@ -165,6 +185,75 @@ class StatTest(unittest.TestCase):
         arrs = set(map(tuple, arrs))
         self.assertEquals(len(arrs), 3)
 
+    def test_random_ranks_order(self):
+        # The first ranks drawn are no smaller than the rest
+        N = num_orderings([range(6), range(6, 12)], [range(12)])
+        means = [ np.mean(random_ranks(N, 800, np.random.RandomState(seed))[:100])
+                  for seed in range(20) ]
+        self.assertTrue(abs(np.mean(means) - (N - 1) / 2.0) < 50)
+
+    def test_random_orderings_near_all(self):
+        np.random.seed(0)
+        cond  = [[0, 1, 4, 5], [2, 3, 6, 7]]
+        block = [[0, 1, 2, 3], [4, 5, 6, 7]]
+        expected = map(tuple, all_orderings(cond, block))
+
+        arrs = map(tuple, random_orderings(cond, block, 35))
+        self.assertEquals(len(set(arrs)), 35)
+        self.assertTrue(set(arrs).issubset(expected))
+
+        groups = block_groups(cond, block)
+        self.assertEquals(
+            [ tuple(unrank_ordering(groups, r)) for r in range(36) ],
+            expected)
+
+    def test_random_indexes(self):
+        layout = [[0, 1, 2], [5, 6], [3, 4, 7, 8]]
+        idxs = random_indexes(layout, 1000, np.random.RandomState(0))
+        self.assertEquals(np.shape(idxs), (1000, 9))
+
+        # Each column only draws from its own group, and every index
+        # in the group gets drawn.
+        p = 0
+        for grp in layout:
+            block = idxs[:, p : p + len(grp)]
+            self.assertEquals(set(np.ravel(block)), set(grp))
+            p += len(grp)
+
+        np.testing.assert_equal(
+            random_indexes(layout, 10, np.random.RandomState(1)),
+            random_indexes(layout, 10, np.random.RandomState(1)))
+
+    def test_sample_index_spec(self):
+        cond  = [[0, 1, 4, 5], [2, 3, 6, 7]]
+        block = [[0, 1, 2, 3], [4, 5, 6, 7]]
+        specs = [ SampleIndexSpec.permutations(cond, block, 20, 5),
+                  SampleIndexSpec.permutations(cond, block, 100, 5),
+                  SampleIndexSpec('bootstrap', [block], 5, 25, block_size=10) ]
+        self.assertEquals(map(len, specs), [20, 36, 25])
+
+        for spec in specs:
+            spec = SampleIndexSpec.from_json(spec.to_json())
+            whole = spec[:]
+            self.assertEquals(np.shape(whole), (len(spec), 8))
+            np.testing.assert_equal(
+                np.concatenate([ spec[0:3], spec[3:12], spec[12:] ]),
+                whole)
+            np.testing.assert_equal(spec[5:5], np.zeros((0, 8), int))
+
+        self.assertEquals(len(set(map(tuple, specs[0][:]))), 20)
+
+        # All of the orderings, but not starting with the unpermuted one
+        self.assertEquals(sorted(map(tuple, specs[1][:])),
+                          sorted(map(tuple, all_orderings(cond, block))))
+        self.assertNotEquals(tuple(specs[1][:1][0]), tuple(range(8)))
+        self.assertRaises(ValueError, SampleIndexSpec, 'bogus', [block], 0, 1)
+
+    def test_num_orderings_exact(self):
+        cond = [ range(i, 90, 3) for i in range(3) ]
+        self.assertEquals(num_orderings(cond),
+                          factorial(90) // factorial(30) ** 3)
+
 
     def test_group_means(self):
 
@@ -327,6 +416,205 @@ class StatTest(unittest.TestCase):
         self.assertEquals(test(np.array([0, 1, 2, 3])), 'AA BB')
         self.assertEquals(test(np.array([0, 2, 0, 3])), 'AB AB')
 
+    def test_bootstrap_batches(self):
+        np.random.seed(0)
+        data = np.random.gamma(2, 10, (50, 8))
+        conds  = [ [0, 1, 2, 3], [4, 5, 6, 7] ]
+        blocks = [ range(8) ]
+        perms = np.array(list(random_orderings(conds, blocks, 20)))
+        alphas = np.array([0.0, 1.0, 10.0])
+
+        for stat in [ FStat(conds, blocks, alphas=alphas),
+                      MeansRatio(conds, blocks, alphas=alphas) ]:
+            raw = stat(data)
+            bins = bins_uniform(10, raw)
+
+            # One sample at a time
+            single = bootstrap(data, stat, permutations=perms, bins=bins,
+                               max_batch_bytes=0)
+            single_stats = bootstrap(data, stat, permutations=perms,
+                                     max_batch_bytes=0)
+
+            # Several samples at a time, with the last batch short
+            batched = bootstrap(data, stat, permutations=perms, bins=bins,
+                                max_batch_bytes=data.nbytes * 6)
+            batched_stats = bootstrap(data, stat, permutations=perms,
+                                      max_batch_bytes=data.nbytes * 6)
+
+            self.assertEquals(np.shape(single_stats), (20, 3, 50))
+            np.testing.assert_almost_equal(single, batched)
+            np.testing.assert_almost_equal(single_stats, batched_stats)
+
+        # The t-tests, on paired samples
+        conds  = [ [0, 2, 4, 6], [1, 3, 5, 7] ]
+        blocks = [ [0, 1], [2, 3], [4, 5], [6, 7] ]
+        perms = np.array(pairedOrderings(4, 20))
+
+        for stat in [ OneSampleTTest(alphas=alphas),
+                      OneSampleDifferenceTStat(conds, blocks, alphas=alphas) ]:
+            single_stats = bootstrap(data, stat, permutations=perms,
+                                     max_batch_bytes=0)
+            batched_stats = bootstrap(data, stat, permutations=perms,
+                                      max_batch_bytes=data.nbytes * 6)
+
+            self.assertEquals(np.shape(single_stats), (len(perms), 3, 50))
+            np.testing.assert_almost_equal(single_stats, batched_stats)
+            np.testing.assert_almost_equal(
+                batched_stats, [ stat(data[..., p]) for p in perms ])
+
+    def test_permuted(self):
+        np.random.seed(0)
+        data = np.random.gamma(2, 10, (50, 12))
+        conds  = [ [0, 1, 2, 6, 7, 8], [3, 4, 5, 9, 10, 11] ]
+        blocks = [ range(6), range(6, 12) ]
+        perms = np.array(list(random_orderings(conds, blocks, 10)))
+        boots = np.array(list(random_indexes(blocks, 10)))
+        alphas = np.array([0.0, 1.0, 10.0])
+
+        for stat in [ FStat(conds, blocks),
+                      FStat(conds, blocks, alphas=alphas),
+                      MeansRatio(conds, blocks),
+                      MeansRatio(conds, blocks, alphas=alphas) ]:
+            for idxs in [ perms, boots ]:
+
+                # Same as building the samples and computing the
+                # statistic on them
+                expected = stat(np.rollaxis(data[..., idxs], -2))
+                np.testing.assert_almost_equal(stat.permuted(data, idxs),
+                                               expected)
+                np.testing.assert_almost_equal(
+                    bootstrap(data, stat, permutations=idxs),
+                    np.rollaxis(expected, -2))
+
+                # Counting the statistics one tuning param at a time
+                # gives the same histogram, in any size of batch.
+                bins = bins_uniform(20, stat(data))
+                lumped = np.reshape(expected, np.shape(bins)[:-1] + (-1,))
+                for budget in [ 1, DEFAULT_MAX_BATCH_BYTES ]:
+                    np.testing.assert_almost_equal(
+                        bootstrap(data, stat, permutations=idxs, bins=bins,
+                                  max_batch_bytes=budget),
+                        cumulative_hist(lumped, bins) / len(idxs))
+
+        # Batches get smaller as each sampling holds more per feature,
+        # but not with more tuning params, since we only hold the
+        # statistics for one of them at a time.
+        budget = 50 * 8 * 200
+        self.assertEquals(
+            [ batch_size(data, budget, stat.permuted_width())
+              for stat in [ FStat(conds, [ range(12) ]),
+                            FStat(conds, blocks),
+                            FStat(conds, blocks, alphas=alphas),
+                            MeansRatio(conds, blocks),
+                            MeansRatio(conds, blocks, alphas=alphas) ] ],
+            [ 200 // (2 * 2 + 2 * 1 + 11),
+              200 // (2 * 4 + 2 * 2 + 11),
+              200 // (2 * 4 + 2 * 2 + 11),
+              200 // (4 * 4 + 5),
+              200 // (4 * 4 + 5) ])
+
+        # With the default budget and tuning params, a two-group table
+        # of 50,000 features and 12 samples gets tens of samplings in
+        # each batch.
+        data = np.zeros((50000, 12))
+        conds = [ range(6), range(6, 12) ]
+        for stat in [ FStat(conds, [ range(12) ], alphas=alphas),
+                      MeansRatio(conds, [ range(12) ], alphas=alphas) ]:
+            self.assertGreaterEqual(
+                batch_size(data, DEFAULT_MAX_BATCH_BYTES, stat.permuted_width()),
+                20)
+
+    def test_default_batch_size(self):
+        # A table of 50,000 features and 12 samples should still get
+        # tens of samples in each batch.
+        data = np.zeros((50000, 12))
+        self.assertGreaterEqual(batch_size(data, DEFAULT_MAX_BATCH_BYTES), 20)
+
+    def test_chunked_percentile(self):
+        np.random.seed(0)
+        table = np.round(np.random.gamma(0.5, 100, (500, 6)))
+        table[np.random.random(table.shape) < 0.2] = 0
+
+        # Many values tie at the 1st percentile; we should find it
+        # without narrowing the range down to nothing.
+        for per in [ 0.0, 1.0, 50.0, 100.0 ]:
+            self.assertEquals(
+                chunked_percentile(table, per, 10, num_bins=4, max_passes=5),
+                np.percentile(table, per))
+
+        # NaNs sort last, so only the top percentiles see them.
+        table[:5, 0] = np.nan
+        self.assertEquals(chunked_percentile(table, 1.0, 10),
+                          scipy.stats.scoreatpercentile(np.ravel(table), 1.0))
+        self.assertTrue(np.isnan(chunked_percentile(table, 100.0, 10)))
+
+    def test_searchsorted_rows(self):
+        np.random.seed(0)
+        bins = np.sort(np.round(np.random.randn(3, 8) * 1e-3, 3), axis=-1)
+        values = np.concatenate([
+                np.random.randn(3, 20) * 1e-3,
+                bins[:, ::2],
+                np.nextafter(bins[:, 1::2], np.inf) ], axis=-1)
+        values[0, 0] = np.nan
+        values[1, 0] = np.inf
+        values[2, 0] = -np.inf
+
+        # The same as searching each row, even for values on or next
+        # to repeated bin edges.
+        for side in [ 'left', 'right' ]:
+            np.testing.assert_equal(
+                searchsorted_rows(bins, values, side=side),
+                [ np.searchsorted(b, v, side=side)
+                  for (b, v) in zip(bins, values) ])
+
+        # The pipeline's bins have infinite edges.
+        stats = np.random.gamma(2, 2, (3, 100))
+        bins = bins_uniform(10, stats)
+        stats[0, :2] = [ -np.inf, np.inf ]
+        stats[1, :2] = bins[1, [0, 5]]
+        for side in [ 'left', 'right' ]:
+            np.testing.assert_equal(
+                searchsorted_rows(bins, stats, side=side),
+                [ np.searchsorted(b, v, side=side)
+                  for (b, v) in zip(bins, stats) ])
+
+    def test_cumulative_hist(self):
+        np.random.seed(0)
+        values = np.random.gamma(2, 2, (3, 2, 100))
+        bins = np.zeros((3, 2, 11))
+        for idx in np.ndindex((3, 2)):
+            bins[idx] = np.linspace(0, np.max(values[idx]) * 0.9, 11)
+            # Put some values right on the edges
+            values[idx][:3] = bins[idx][[0, 4, 10]]
+
+        hist = cumulative_hist(values, bins)
+        self.assertEquals(np.shape(hist), (3, 2, 10))
+
+        for idx in np.ndindex((3, 2)):
+            (expected, ignore) = np.histogram(values[idx], bins[idx])
+            np.testing.assert_equal(hist[idx], np.cumsum(expected[::-1])[::-1])
+
+        counts = np.zeros((3, 2, 10))
+        add_cumulative_hist(counts, values, bins)
+        add_cumulative_hist(counts, values, bins)
+        np.testing.assert_equal(counts, hist * 2)
+
+    def test_assign_scores_to_features(self):
+        np.random.seed(0)
+        stats = np.random.gamma(2, 2, (3, 100))
+        bins = bins_uniform(10, stats)
+        scores = np.cumsum(np.random.random((3, 10)), axis=1)
+        stats[:, 0] = bins[:, 4]
+
+        res = assign_scores_to_features(stats, bins, scores)
+
+        for idx in np.ndindex(np.shape(stats)):
+            i = idx[0]
+            bin_idx = np.sum(bins[i] <= stats[idx]) - 1
+            self.assertEquals(res[idx], scores[i, bin_idx])
+            self.assertEquals(
+                ScoreLookup(bins, scores).bin_indexes(stats)[idx], bin_idx)
+
     def test_glm_without_alphas(self):
 
         data = np.array([
@@ -0,0 +1,277 @@
+import unittest
+import os
+import h5py
+import numpy as np
+
+from contextlib import closing
+
+import pade.analysis as an
+from pade.test.utils import tempdir
+from pade.model import Schema, Settings
+from pade.stat import DEFAULT_MAX_BATCH_BYTES
+from pade.tasks import (
+    copy_input, input_cache_path, set_storage, create_dataset, open_job,
+    load_job, loaded_nbytes, load_summary_index, summary_index_path,
+    compute_raw_stats, gen_sample_indexes, load_sample_indexes,
+    choose_bins, compute_mean_perm_count, steps)
+
+class TasksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.infile = 'sample_jobs/two_cond/sample_data_2_cond.txt'
+        with open('sample_jobs/two_cond/pade_schema.yaml') as f:
+            self.schema = Schema.load(f)
+        self.settings = Settings(stat='f')
+
+    def test_copy_input_cache(self):
+        with tempdir() as tmp:
+            cache_dir = os.path.join(tmp, 'cache')
+            first  = os.path.join(tmp, 'first.pade')
+            second = os.path.join(tmp, 'second.pade')
+
+            copy_input(first, self.infile, self.schema, self.settings, 1, cache_dir)
+            cache_path = input_cache_path(cache_dir, self.infile, self.schema)
+            self.assertEquals(os.listdir(cache_dir),
+                              [ os.path.basename(cache_path) ])
+
+            copy_input(second, self.infile, self.schema, self.settings, 2, cache_dir)
+
+            with h5py.File(first, 'r') as a, h5py.File(second, 'r') as b:
+                np.testing.assert_equal(a['table'][...], b['table'][...])
+                np.testing.assert_equal(a['feature_ids'][...], b['feature_ids'][...])
+                self.assertEquals(b.attrs['job_id'], 2)
+
+            # Reading different columns of the file is a different entry
+            self.schema.column_roles[1] = 'ignored'
+            self.assertNotEquals(
+                input_cache_path(cache_dir, self.infile, self.schema),
+                cache_path)
+
+    def test_create_dataset(self):
+        with tempdir() as tmp:
+            with h5py.File(os.path.join(tmp, 'db.h5'), 'w') as db:
+
+                # Files without a storage layout are contiguous
+                self.assertEquals(
+                    create_dataset(db, 'old', data=np.zeros((10, 3))).chunks,
+                    None)
+
+                set_storage(db, 'gzip', 4)
+
+                table = create_dataset(db, 'table', data=np.zeros((10, 3)))
+                self.assertEquals(table.chunks, (4, 3))
+                self.assertEquals(table.compression, 'gzip')
+
+                stats = create_dataset(db['/'], 'stats', (2, 10), float,
+                                       feature_axis=-1)
+                self.assertEquals(stats.chunks, (2, 4))
+
+                grow = create_dataset(db, 'grow', (0, 3), float,
+                                      maxshape=(None, 3))
+                grow.resize(10, axis=0)
+                self.assertEquals(grow.chunks, (4, 3))
+
+                empty = create_dataset(db, 'empty', (10, 0), float)
+                self.assertEquals(empty.chunks, None)
+
+                self.assertRaises(ValueError, set_storage, db, 'bogus')
+                self.assertRaises(ValueError, set_storage, db, 'gzip', 0)
+                self.assertRaises(ValueError, set_storage, db, None, -1)
+                self.assertEquals(db.attrs['compression'], 'gzip')
+
+    def test_open_job(self):
+        with tempdir() as tmp:
+            path = os.path.join(tmp, 'job.pade')
+            copy_input(path, self.infile, self.schema, self.settings, 1)
+
+            job = open_job(path, 10, 20)
+            try:
+                self.assertFalse('table' in job.input.__dict__)
+                self.assertEquals(job.results.raw_stats, None)
+
+                expected = load_job(path).input.table
+                np.testing.assert_equal(job.input.table, expected[10 : 20])
+                self.assertTrue('table' in job.input.__dict__)
+            finally:
+                job.close()
+
+            # Things we already read are still there after closing, and
+            # anything else is read by reopening the file
+            self.assertEquals(np.shape(job.input.table), (10, 8))
+            self.assertEquals(job.db, None)
+            self.assertEquals(len(job.input.feature_ids), 10)
+            self.assertEquals(loaded_nbytes(job), expected[10 : 20].nbytes +
+                              job.input.feature_ids.nbytes)
+
+    def test_summary_index(self):
+        with tempdir() as tmp:
+            path = os.path.join(tmp, 'job.pade')
+            copy_input(path, self.infile, self.schema, self.settings, 1)
+            self.assertEquals(load_summary_index(path), None)
+            self.assertFalse(os.path.exists(summary_index_path(path)))
+
+            with h5py.File(path, 'r+') as db:
+                grp = db.create_group('summary')
+                grp['bins']            = [ 0.5, 0.75, 1.0 ]
+                grp['best_param_idxs'] = [ 0, 1, 1 ]
+                grp['counts']          = [ 100, 20, 0 ]
+
+            # The first load reads the job and saves the index
+            summary = load_summary_index(path)
+            self.assertTrue(os.path.exists(summary_index_path(path)))
+            np.testing.assert_equal(summary.counts, [ 100, 20, 0 ])
+
+            with h5py.File(path, 'r+') as db:
+                del db['summary']
+            summary = load_summary_index(path)
+            np.testing.assert_equal(summary.bins, [ 0.5, 0.75, 1.0 ])
+            np.testing.assert_equal(summary.best_param_idxs, [ 0, 1, 1 ])
+
+    def test_feature_moments(self):
+        with tempdir() as tmp:
+            path = os.path.join(tmp, 'job.pade')
+            copy_input(path, self.infile, self.schema, self.settings, 1)
+            compute_raw_stats(path, chunk_size=7)
+
+            job = load_job(path)
+            np.testing.assert_almost_equal(job.results.feature_means,
+                                           np.mean(job.input.table, axis=1))
+            np.testing.assert_almost_equal(job.results.feature_variances,
+                                           np.var(job.input.table, axis=1))
+
+    def test_sample_indexes(self):
+        with tempdir() as tmp:
+            path = os.path.join(tmp, 'job.pade')
+            settings = Settings(stat='f', num_samples=20,
+                                condition_variables=['treated'])
+            copy_input(path, self.infile, self.schema, settings, 1)
+            gen_sample_indexes(path)
+
+            with h5py.File(path, 'r') as db:
+                self.assertFalse('sample_indexes' in db)
+
+            indexes = load_job(path).results.sample_indexes
+            self.assertEquals(np.shape(indexes[:]), (20, 8))
+            with closing(open_job(path)) as job:
+                np.testing.assert_equal(job.results.sample_indexes[10:20],
+                                        indexes[10:20])
+
+            # Indexes given in a file are stored as they are
+            other = os.path.join(tmp, 'other.pade')
+            idx_path = os.path.join(tmp, 'indexes.txt')
+            np.savetxt(idx_path, indexes[:5], fmt='%d')
+            copy_input(other, self.infile, self.schema, settings, 2)
+            load_sample_indexes(other, idx_path)
+            np.testing.assert_equal(load_job(other).results.sample_indexes,
+                                    indexes[:5])
+
+    def test_adaptive_perm_count(self):
+        with tempdir() as tmp:
+            paths = [ os.path.join(tmp, name + '.pade')
+                      for name in ['full', 'adaptive'] ]
+            for (i, tolerance) in enumerate([ None, 1.0 ]):
+                settings = Settings(stat='f', num_samples=20,
+                                    condition_variables=['treated'],
+                                    stop_tolerance=tolerance)
+                copy_input(paths[i], self.infile, self.schema, settings, i)
+                np.random.seed(0)
+                gen_sample_indexes(paths[i])
+                compute_raw_stats(paths[i])
+                choose_bins(paths[i])
+                compute_mean_perm_count(paths[i], num_shards=2)
+
+            (full, adaptive) = [ load_job(path) for path in paths ]
+            self.assertEquals(full.settings.stop_tolerance, None)
+            self.assertEquals(adaptive.settings.stop_tolerance, 1.0)
+            self.assertEquals(full.results.num_samples_used, 20)
+
+            # A single round runs all the samples, split across the
+            # shards, and gives the same counts.
+            self.assertEquals(adaptive.results.num_samples_used, 20)
+            np.testing.assert_almost_equal(
+                adaptive.results.bin_to_mean_perm_count,
+                full.results.bin_to_mean_perm_count)
+
+            # With a loose tolerance we stop after two comparisons of
+            # three rounds
+            adaptive.settings.stop_tolerance = 1000.0
+            (mean, num_used) = an.adaptive_mean_perm_count(adaptive, interval=5)
+            self.assertEquals(num_used, 15)
+            np.testing.assert_almost_equal(
+                mean, an.compute_mean_perm_count(adaptive, 0, 15))
+
+    def test_adaptive_perm_count_noisy(self):
+        with tempdir() as tmp:
+            path = os.path.join(tmp, 'job.pade')
+            settings = Settings(stat='f', num_samples=60,
+                                condition_variables=['treated'],
+                                stop_tolerance=0.0)
+            copy_input(path, self.infile, self.schema, settings, 1)
+            np.random.seed(0)
+            gen_sample_indexes(path)
+            compute_raw_stats(path)
+            choose_bins(path)
+            job = load_job(path)
+
+            # The counts happen to repeat between the rounds ending at
+            # 25 and 30 samples, and then keep moving, so a single
+            # settled check stops too early.
+            self.assertEquals(
+                an.adaptive_mean_perm_count(job, interval=5, checks=1)[1], 30)
+            self.assertEquals(
+                an.adaptive_mean_perm_count(job, interval=5)[1], 60)
+
+            # The pool's processes each load the job once, and give
+            # the same result.
+            compute_mean_perm_count(path, num_shards=2)
+            job = load_job(path)
+            self.assertEquals(job.results.num_samples_used, 60)
+            np.testing.assert_almost_equal(
+                job.results.bin_to_mean_perm_count,
+                an.compute_mean_perm_count(job))
+
+    def test_max_batch_bytes(self):
+        with tempdir() as tmp:
+            paths = [ os.path.join(tmp, name + '.pade')
+                      for name in ['default', 'small'] ]
+            for (i, budget) in enumerate([ None, 1 ]):
+                kwargs = {} if budget is None else { 'max_batch_bytes' : budget }
+                settings = Settings(stat='f', num_samples=20,
+                                    condition_variables=['treated'], **kwargs)
+                copy_input(paths[i], self.infile, self.schema, settings, i)
+                np.random.seed(0)
+                gen_sample_indexes(paths[i])
+                compute_raw_stats(paths[i])
+                choose_bins(paths[i])
+                compute_mean_perm_count(paths[i])
+
+            (default, small) = [ load_job(path) for path in paths ]
+            self.assertEquals(default.settings.max_batch_bytes,
+                              DEFAULT_MAX_BATCH_BYTES)
+            self.assertEquals(small.settings.max_batch_bytes, 1)
+
+            # Batching doesn't change the counts
+            np.testing.assert_almost_equal(
+                small.results.bin_to_mean_perm_count,
+                default.results.bin_to_mean_perm_count)
+
+    def test_distrib_steps(self):
+        # Celery workers can't start process pools, so only the
+        # permutation counts are sharded when distributed.
+        settings = Settings(stat='f')
+        sigs = steps(settings, self.schema, self.infile, None, 'job.pade', 1,
+                     num_shards=4, distrib=True)
+        tasks = [ sig.task for sig in sigs ]
+        self.assertEquals(sigs[tasks.index('pade.tasks.compute_raw_stats')].args,
+                          ('job.pade', 1))
+        self.assertFalse('pade.tasks.compute_mean_perm_count' in tasks)
+
+    def test_distrib_adaptive_steps(self):
+        # Celery workers can't start process pools, so the adaptive
+        # permutation task doesn't shard when distributed.
+        settings = Settings(stat='f', stop_tolerance=0.01)
+        sigs = steps(settings, self.schema, self.infile, None, 'job.pade', 1,
+                     num_shards=4, distrib=True)
+        args = dict((sig.task, sig.args) for sig in sigs)
+        self.assertEquals(args['pade.tasks.compute_mean_perm_count'],
+                          ('job.pade', 1))
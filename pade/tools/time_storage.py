@@ -0,0 +1,73 @@
+"""Compare read and write throughput of the HDF5 storage layouts.
+
+Usage: python -m pade.tools.time_storage [NUM_FEATURES [NUM_SAMPLES]]
+
+"""
+from __future__ import print_function, division
+
+import sys
+import os
+import time
+import tempfile
+import shutil
+
+import h5py
+import numpy as np
+
+from pade.tasks import set_storage, create_dataset, DEFAULT_CHUNK_FEATURES
+
+LAYOUTS = [
+    ('contiguous', None,   0),
+    ('chunked',    None,   DEFAULT_CHUNK_FEATURES),
+    ('gzip',       'gzip', DEFAULT_CHUNK_FEATURES),
+    ('lzf',        'lzf',  DEFAULT_CHUNK_FEATURES)]
+
+def time_fn(f, *args, **kwargs):
+    start = time.time()
+    res = f(*args, **kwargs)
+    end = time.time()
+    return (end - start, res)
+
+def write(path, table, compression, chunk_features):
+    with h5py.File(path, 'w') as db:
+        set_storage(db, compression, chunk_features)
+        create_dataset(db, 'table', data=table)
+
+def read_all(path):
+    with h5py.File(path, 'r') as db:
+        return db['table'][...]
+
+def read_ranges(path, starts, size):
+    with h5py.File(path, 'r') as db:
+        table = db['table']
+        return [ table[start : start + size] for start in starts ]
+
+def main():
+    num_features = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    num_samples  = int(sys.argv[2]) if len(sys.argv) > 2 else 12
+
+    # Something like RNA-seq counts
+    table = np.round(np.random.gamma(0.5, 100, (num_features, num_samples)))
+    mb = table.nbytes / 1e6
+    starts = np.random.randint(0, max(1, num_features - 1000), 100)
+
+    tmp = tempfile.mkdtemp()
+    try:
+        print("{0:>12} {1:>10} {2:>10} {3:>10} {4:>12}".format(
+                "layout", "size (MB)", "write MB/s", "read MB/s", "ranges (s)"))
+
+        for (name, compression, chunk_features) in LAYOUTS:
+            path = os.path.join(tmp, name + '.h5')
+            (write_time, ignore) = time_fn(write, path, table, compression, chunk_features)
+            (read_time, res)     = time_fn(read_all, path)
+            (ranges_time, ignore) = time_fn(read_ranges, path, starts, 1000)
+            assert np.array_equal(res, table)
+
+            print("{0:>12} {1:>10.1f} {2:>10.1f} {3:>10.1f} {4:>12.3f}".format(
+                    name, os.path.getsize(path) / 1e6, mb / write_time,
+                    mb / read_time, ranges_time))
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()